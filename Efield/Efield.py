@@ -1,13 +1,13 @@
 import os, re, time, pathlib ,datetime ,glob ,sys 
-import urllib.request
 import shutil
 import pandas as pd
 import numpy as np
 import concurrent.futures
 
 import json
-from bs4 import BeautifulSoup
 from b3d import B3D
+from efield_download import download_new
+from efield_ingest import parse_geojson, DayBuffer, DayStore
 
 import logging
 import logging.config
@@ -43,6 +43,8 @@ logger = logging.getLogger("time_lapse")
 logger.debug(f"set os path to {sys.path}")
 
 
+FLUSH_SNAPSHOTS = int(os.environ.get("FLUSH_SNAPSHOTS", 200))  # snapshots buffered before they are written to the day stores
+
 
 def get_date(url):
     """Get the date from the url"""
@@ -54,14 +56,6 @@ def get_date(url):
         return [None, None]
 
 
-def get_urls(url):
-    response = urllib.request.urlopen(url)
-    soup = BeautifulSoup(response, "html5lib")
-    urls = [i["href"] for i in soup.find_all("a", href=True)]
-    urls = [i for i in urls if i.endswith(".json")]
-    return urls
-
-
 def decode(path):
     with open(path, "r") as f:
         data = json.load(f)
@@ -69,6 +63,24 @@ def decode(path):
     return df
 
 
+def read_snapshots(path):
+    """
+    One parquet of snapshots as flat lon, lat, Ex, Ey, near and date columns. Parquets written
+    before DayStore hold either one normalized feature collection each, converted here, or flat columns.
+    """
+    df = pd.read_parquet(path)
+    if "geometry.coordinates" in df:
+        df = pd.DataFrame({
+            "lon": df["geometry.coordinates"].str[0],
+            "lat": df["geometry.coordinates"].str[1],
+            "Ex": df["properties.Ex"],
+            "Ey": df["properties.Ey"],
+            "near": df["properties.distance_nearest_station"],
+            "date": df["date"],
+        })
+    return df
+
+
 def check():
     check_dir = lambda path: True if os.path.exists(path) else os.makedirs(path)
 
@@ -92,74 +104,45 @@ def check():
 
 
 
+def save_snapshot(buffer, typ, href, body):
+    """
+    Parse one downloaded snapshot into the day buffer. A file that cannot be decoded is saved as
+    data/{typ}/YYYYMMDD/{name}, or as data/{typ}/undated/{name} if its name carries no date.
+    """
+    date = pd.to_datetime(get_date(href)[0], utc=True)
+    try:
+        if pd.isna(date):
+            raise ValueError(f"no date in {href}")
+        buffer.append(date, parse_geojson(body))
+    except Exception as e:  # if it fails then save the data as json
+        logger.info(e)
+        path = f"data/{typ}/{'undated' if pd.isna(date) else date.strftime('%Y%m%d')}"
+        os.makedirs(path, exist_ok=True)
+        with open(f"{path}/{os.path.basename(href)}", "wb") as out_file:
+            out_file.write(body)
+
+
 def get_data(base_url, meta_path, typ="1D", limit=None):
-    meta= pd.read_csv(meta_path)
-    check_dir = lambda path: True if os.path.exists(path) else os.makedirs(path)
-    df = pd.DataFrame(get_urls(base_url), columns=["url"], dtype=str)
-    df["date"], df["group"] = zip(*df["url"].map(get_date))  # split the date and group
-    df.dropna(inplace=True)  # drop the data that does not have date
-    df["downloaded"] = False  # assume is not downloaded
+    """
+    Download the snapshots of `base_url` not yet downloaded according to the meta csv, concurrently
+    (see efield_download.py), and record them in the meta csv. Failed files are retried next run.
+    The snapshots are parsed into a DayBuffer as they arrive and written every FLUSH_SNAPSHOTS
+    snapshots, and once more when the download ends or fails.
+    """
+    meta = pd.read_csv(meta_path)
+    seen = set(meta.loc[meta["downloaded"] == True, "url"])
+    buffer = DayBuffer(f"data/{typ}", flush_every=FLUSH_SNAPSHOTS)
+    try:
+        results = download_new(base_url, lambda href, body: save_snapshot(buffer, typ, href, body), seen=seen,
+                                limit=limit, desc=f"Downloading {typ}")
+    finally:
+        buffer.flush()
+
+    df = pd.DataFrame({"url": list(results), "downloaded": list(results.values())})
+    df["date"], df["group"] = zip(*df["url"].map(get_date)) if len(df) else ([], [])  # split the date and group
     df["date"] = pd.to_datetime(df["date"], utc=True)  # set the time zone
-    df["group"] = df["group"]
-    meta["date"] = pd.to_datetime(meta["date"], utc=True)
-    df=df[~df["url"].isin(meta["url"])]  # filter the data that is already downloaded
-    
-    # Limit for testing
-    if limit is not None:
-        df = df.head(limit)
-    
-    logger.info(f"Downloading {len(df)} data files from {base_url}")
-    i = 0
-    fail = 0
-    attempt = 0
-    
-    total_files = max(len(df) - 2, 0)
-    with tqdm(total=total_files, desc=f"Downloading {typ}", unit="file") as pbar:
-        try:
-            while i+2 < (len(df)): # the last two data is no always available
-                url = base_url + os.path.basename(df.iloc[i]["url"])
-                logger.debug(f"Downloading {url}")
-                path = f"data/{typ}/{df.iloc[i]['date'].strftime('%Y%m%d')}"
-                check_dir(path)
-                now = time.time_ns()
-                try:  # * first try to download the data
-                    response = urllib.request.urlopen(url).read()
-                except Exception as e:
-                    logger.info(e)
-                    attempt += 1
-                    if attempt > 2:
-                        fail+=1
-                        i += 1
-                    time.sleep(2)  # wait for 2 seconds before trying again
-                    continue
-                
-                # meta = meta.append(df.iloc[i])
-                get_timer = time.time_ns() - now
-                try:  # * then try to save the data to csv
-                    data = json.loads(response.decode("utf-8"))
-                    df_ = pd.json_normalize(data, "features")
-                    df_['date'] = df.iloc[i]['date'] # add the date to the data
-                    df_.to_parquet(f"{path}/{pathlib.Path(os.path.basename(df.iloc[i]['url'])).stem}.parquet")
-                except Exception as e:  # if it fails then save the data as json
-                    logger.info(e)
-                    with open(f"{path}/{df.iloc[i]['url']}", "w") as out_file:
-                        json.dump(data, out_file)
-                decode_timer = time.time_ns() - now  # * Calculate the time taken to download the file
-
-                sleep = (2e9 - decode_timer) / 1e9  # just hitting the download limit( NCEP has predetermined download limit 50 hits/minutes)
-                if sleep > 0:
-                    time.sleep(sleep)  # * Delay for exactly 1 second
-                logger.debug(f"took {get_timer//1e6} ms to download file {df.iloc[i]['url']} , {decode_timer//1e6} ms to decode the file")
-                df.loc[i, "downloaded"] = True
-                i += 1
-                pbar.update(1)
-        except Exception as e:
-            logger.info(f"data downloaded interrupted casue by{e} ")
-        
-    
-    logger.info(f"Download completed, failed to download {fail} files")
-    meta = pd.concat([meta, df], axis=0)
-    meta.drop_duplicates(inplace=True, keep="last")  # keep the last update of the data
+    logger.info(f"Download completed, failed to download {(~df['downloaded']).sum()} files")
+    meta = pd.concat([meta[~meta["url"].isin(df["url"])], df], axis=0)  # keep the last attempt of every file
     meta.to_csv(meta_path, index=False)
     return len(df)
 
@@ -170,14 +153,18 @@ def get_data(base_url, meta_path, typ="1D", limit=None):
 
 
 
-def df_to_b3d(df, path): #? this method is not optimized, may be try geojson format https://geopandas.org/en/stable/docs/reference/api/geopandas.GeoDataFrame.html
-    
+def df_to_b3d(df, path):
+    """
+    Grid the snapshots of a day (lon, lat, Ex, Ey, near and date columns, see read_snapshots) into a B3D file.
+    Every row gets integer date, lat and lon codes from np.unique(return_inverse=True), and Ex/Ey are
+    scattered into NaN-initialised (time, lat*lon) float32 arrays with one fancy-index assignment.
+    Grid points missing from a snapshot stay NaN; n_station comes from the first snapshot (-1 if missing).
+    """
     print(f"Starting df_to_b3d for {path}")
     print(f"Input dataframe shape: {df.shape}")
     
-    b3d = B3D()
-    df['lat'], df['lon'] = df['geometry.coordinates'].str[0], df['geometry.coordinates'].str[1]
-    df.rename(columns={'properties.Ex':'Ex', 'properties.Ey':'Ey', 'properties.distance_nearest_station':'near'}, inplace=True)
+    # b3d.lat has always been filled from coordinates[0] and b3d.lon from coordinates[1]
+    df = df.rename(columns={'lon': 'lat', 'lat': 'lon'})
 
     df = df[['lat','lon','Ex','Ey','near','date']].copy()  # Make explicit copy
     df.dropna(inplace=True)
@@ -185,10 +172,11 @@ def df_to_b3d(df, path): #? this method is not optimized, may be try geojson for
 
     print(f"After cleaning, dataframe shape: {df.shape}")
     
-    df = df.sort_values(by=['date', 'lat', 'lon'])
-    unique_dates = df['date'].unique()
-    unique_lon = df['lon'].unique()
-    unique_lat = df['lat'].unique()
+    # Integer codes of every row on the sorted date, lat and lon axes
+    dates = df['date'].values.astype("datetime64[ns]").view("int64")
+    unique_dates, t_idx = np.unique(dates, return_inverse=True)
+    unique_lat, lat_idx = np.unique(df['lat'].to_numpy(dtype=np.double), return_inverse=True)
+    unique_lon, lon_idx = np.unique(df['lon'].to_numpy(dtype=np.double), return_inverse=True)
     
     print(f"Unique dates: {len(unique_dates)}")
     print(f"Unique lons: {len(unique_lon)}")
@@ -197,43 +185,44 @@ def df_to_b3d(df, path): #? this method is not optimized, may be try geojson for
     lon, lat = np.meshgrid(unique_lon, unique_lat)
     lat = lat.flatten()
     lon = lon.flatten()
+    j = lat_idx * len(unique_lon) + lon_idx  # position of every row in the flattened grid
     
     print(f"Grid size: {len(lat)} points")
     
-    b3d.lat= np.array(lat, dtype=np.double)
-    b3d.lon =np.array(lon, dtype=np.double)
-    ex =np.empty([len(unique_dates), len(lon)])
-    ey =np.empty([len(unique_dates), len(lon)])
-    sta_flag= True
+    ex = np.full([len(unique_dates), len(lon)], np.nan, dtype=np.single)
+    ey = np.full([len(unique_dates), len(lon)], np.nan, dtype=np.single)
+    ex[t_idx, j] = df['Ex'].to_numpy(dtype=np.single)
+    ey[t_idx, j] = df['Ey'].to_numpy(dtype=np.single)
     n_station = np.ones_like(lon) * -1 # Initialize with -1 to indicate missing data
-    df.set_index(['date', 'lon', 'lat'], inplace=True) # reference https://pandas.pydata.org/docs/user_guide/advanced.html
+    first = t_idx == 0
+    n_station[j[first]] = df['near'].to_numpy(dtype=np.double)[first]
     
-    print(f"Starting date processing loop for {len(unique_dates)} dates...")
-    for i, date in enumerate(unique_dates):
-        # No individual date printing - just process silently
-        
-        date_data = df.loc[date]  # Extract data for the current date
-        for j, (lo, la) in enumerate(zip(lon, lat)):
-            try:
-                ex[i, j] = date_data.loc[(lo,la)]['Ex']
-                ey[i, j] = date_data.loc[(lo,la)]['Ey']
-                if sta_flag:
-                    n_station[j] = date_data.loc[(lo,la)]['near']
-            except KeyError:
-                # If the key is not found, ex[i, j] and ey[i, j] remain NaN
-                pass
-        sta_flag = False
-    
-    print("Date processing complete, creating B3D object...")
-    df.reset_index(inplace=True)
-    b3d.ex = np.array(ex, dtype=np.single)
-    b3d.ey = np.array(ey, dtype=np.single)
+    print("Gridding complete, creating B3D object...")
+    write_b3d(path, lat, lon, unique_dates, ex, ey, n_station)
+
+
+def store_to_b3d(store, path):
+    """Write the B3D file of a DayStore: its (nt, n) Ex/Ey records are read in one go and written as they are."""
+    print(f"Starting store_to_b3d for {path}")
+    times, ex, ey = store.read()
+    print(f"Snapshots: {len(times)}, grid size: {store.n} points")
+    # Same grid order as df_to_b3d: b3d.lat from coordinates[0] (store.x), b3d.lon from coordinates[1] (store.y)
+    write_b3d(path, np.repeat(store.x, len(store.y)), np.tile(store.y, len(store.x)), times, ex, ey, store.near)
+    return len(times)
+
+
+def write_b3d(path, lat, lon, times, ex, ey, n_station):
+    """Write a B3D file from the flattened grid, the int64 ns snapshot times and the (time, n) float32 Ex/Ey."""
+    b3d = B3D()
+    b3d.lat= np.array(lat, dtype=np.double)
+    b3d.lon =np.array(lon, dtype=np.double)
+    b3d.ex = ex
+    b3d.ey = ey
     b3d.n_station = np.array(n_station, dtype=np.double)
-    b3d.time_0 = int(unique_dates.astype("int64")[0] /(10**9)+86400) # convert to days since 1970-01-01
-    today_begin = unique_dates[0].replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
-    b3d.time = np.uint32((unique_dates.astype("int64")- unique_dates.astype("int64")[0])/10**9) # convert to seconds since the offset
+    b3d.time_0 = int(times[0] /(10**9)+86400) # convert to days since 1970-01-01
+    b3d.time = np.uint32((times - times[0])/10**9) # convert to seconds since the offset
     b3d.time_units = 1
-    logger.info(f" converting {len(unique_dates)} dates to b3d")
+    logger.info(f" converting {len(times)} dates to b3d")
     b3d.comment = os.path.basename(path)[0]
     
     print(f"Writing B3D file to {path}")
@@ -249,30 +238,61 @@ def df_to_b3d(df, path): #? this method is not optimized, may be try geojson for
 
 
 
+def import_snapshots(files, store):
+    """
+    Append the snapshots of parquets written before DayStore (see read_snapshots) to the day's store,
+    renaming each parquet to .parquet.imported as soon as its snapshots are in, so a later run does
+    not append it again (the store sorts by time when read, so the file order does not matter).
+    """
+    for f in sorted(files):
+        df = read_snapshots(f)
+        dates = df['date'].values.astype("datetime64[ns]").view("int64")
+        order = np.argsort(dates, kind="stable")
+        unique_dates, starts = np.unique(dates[order], return_index=True)
+        columns = {column: df[column].to_numpy(dtype=np.double)[order] for column in ['lon', 'lat', 'Ex', 'Ey', 'near']}
+        for date, rows in zip(unique_dates, np.split(np.arange(len(order)), starts[1:])):
+            store.append(date, {column: values[rows] for column, values in columns.items()})
+        os.replace(f, f + ".imported")
+
+
 def process_data(typ="1D",day=(datetime.datetime.now() - datetime.timedelta(days=1)).strftime('%Y%m%d')):
+    """
+    Write data/{typ}/{day}_{typ}.b3d from the day's store (data/{typ}/{day}/, see DayStore).
+    Days downloaded before the store existed still have one parquet per snapshot: a day with only
+    parquets is built from them, a day with both has its parquets appended to the store first (once).
+    Returns the number of snapshots (or parquet files) processed.
+    """
     print(f"process_data called with typ={typ}, day={day}")
-    pattern = f"data/{typ}/{day}/*.parquet"
-    print(f"Looking for files matching: {pattern}")
-    files=glob.glob(pattern)
-    print(f"Found {len(files)} parquet files")
-    if len(files)!=0:
-        logger.info(f"Processing {len(files)} files, for {day}")
-        print(f"Processing {len(files)} files, for {day}")
-        try:
-            df = pd.concat([pd.read_parquet(f) for f in files])
+    folder = f"data/{typ}/{day}"
+    output_path = f"data/{typ}/{day}_{typ}.b3d"
+    files = glob.glob(f"{folder}/*.parquet")
+    store = DayStore(folder) if os.path.exists(f"{folder}/time.i8") else None
+    print(f"Found {len(files)} parquet files, {store.nt if store else 0} stored snapshots")
+    if store is None and len(files) == 0:
+        logger.info(f"No data found for {day}")
+        print(f"No data found for {day}")
+        return 0
+    try:
+        if store is None:
+            logger.info(f"Processing {len(files)} files, for {day}")
+            df = pd.concat([read_snapshots(f) for f in files])
             print(f"Concatenated dataFrame shape: {df.shape}")
-            output_path = f"data/{typ}/{day}_{typ}.b3d"
             print(f"Creating B3D file: {output_path}")
             df_to_b3d(df, output_path)
-            print(f"B3D file created successfully!")
-        except Exception as e:
-            print(f"Error during processing: {e}")
-            import traceback
-            traceback.print_exc()
-    else:
-        logger.info(f"No data found for {day}")
-        print(f"No data found for {day}")
-    return len(files)
+            return len(files)
+        if files:
+            print(f"Appending {len(files)} parquet files to the store")
+            import_snapshots(files, store)
+        logger.info(f"Processing {store.nt} snapshots, for {day}")
+        print(f"Creating B3D file: {output_path}")
+        snapshots = store_to_b3d(store, output_path)
+        print(f"B3D file created successfully!")
+        return snapshots
+    except Exception as e:
+        print(f"Error during processing: {e}")
+        import traceback
+        traceback.print_exc()
+        return 0
 
 
 
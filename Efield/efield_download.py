@@ -0,0 +1,131 @@
+import os
+import re
+import time
+import random
+import asyncio
+import logging
+
+import aiohttp
+from tqdm import tqdm
+
+logger = logging.getLogger("time_lapse")
+
+HITS_PER_MINUTE = int(os.environ.get("SWPC_HITS_PER_MINUTE", 50))  # requests started per minute, listing included
+BURST = 2
+CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", 4))  # requests in flight at once
+RETRIES = int(os.environ.get("DOWNLOAD_RETRIES", 3))  # attempts per file before it is given up
+RETRY_DELAY = 2  # seconds before the first retry, doubled per attempt up to MAX_RETRY_DELAY
+MAX_RETRY_DELAY = 60
+TIMEOUT = aiohttp.ClientTimeout(total=120, sock_read=30)
+SKIP_NEWEST = 2  # the newest files of a listing are not always available yet
+
+HREF = re.compile(rb'href="([^"]+\.json)"')
+STAMP = re.compile(r"(\d{8})T(\d{6})-(\d{2})-?")
+
+
+class TokenBucket:
+    """Asyncio token bucket: never more than `per_minute` requests start in any 60 s window."""
+
+    def __init__(self, per_minute=HITS_PER_MINUTE, burst=BURST):
+        self.rate = (per_minute - burst) / 60
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait for a token; callers are served in arrival order."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def list_files(session, url):
+    """
+    Hrefs of the .json files in a directory listing, parsed chunk by chunk as the listing streams in.
+    Files without a timestamp in their name are dropped; the rest are returned oldest first.
+    """
+    hrefs = []
+    tail = b""
+    async with session.get(url) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_chunked(1 << 16):
+            buffer = tail + chunk
+            end = 0
+            for match in HREF.finditer(buffer):
+                hrefs.append(match.group(1).decode())
+                end = match.end()
+            tail = buffer[max(end, len(buffer) - 1024):]  # an href cut by the chunk boundary
+    stamped = [(STAMP.search(href), href) for href in hrefs]
+    return [href for match, href in sorted((m.groups(), href) for m, href in stamped if m)]
+
+
+async def fetch_file(session, bucket, slots, url, retries=RETRIES):
+    """
+    Download one file into memory, retrying with jittered exponential backoff. A retry only waits
+    for its own file; the slot is released while it sleeps. Returns the bytes, or None if every attempt failed.
+    """
+    for attempt in range(retries):
+        try:
+            async with slots:
+                # Take the token only once a slot is free: tokens taken while queued would be spent in a burst
+                await bucket.acquire()
+                async with session.get(url) as response:
+                    response.raise_for_status()
+                    return await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            delay = min(MAX_RETRY_DELAY, RETRY_DELAY * 2**attempt) * random.uniform(0.5, 1.5)
+            logger.info(f"Error downloading {os.path.basename(url)} (attempt {attempt + 1}/{retries}): {e!r}")
+            if attempt + 1 < retries:
+                await asyncio.sleep(delay)
+    logger.error(f"Failed to download {os.path.basename(url)} after {retries} attempts")
+    return None
+
+
+async def fetch_new(base_url, handle, seen=(), limit=None, per_minute=HITS_PER_MINUTE, concurrency=CONCURRENCY,
+                    retries=RETRIES, desc="Downloading"):
+    """
+    List `base_url` and download every file not in `seen` (hrefs), except the SKIP_NEWEST newest,
+    over one keep-alive session with `concurrency` requests in flight and at most `per_minute`
+    started per minute. handle(href, body) runs in a worker thread as each file arrives.
+    Returns {href: True if downloaded and handled} in listing (time) order.
+    """
+    bucket = TokenBucket(per_minute)
+    slots = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=60)
+    async with aiohttp.ClientSession(connector=connector, timeout=TIMEOUT) as session:
+        await bucket.acquire()
+        hrefs = [href for href in await list_files(session, base_url) if href not in seen]
+        hrefs = hrefs[:max(len(hrefs) - SKIP_NEWEST, 0)][:limit]
+        logger.info(f"Downloading {len(hrefs)} data files from {base_url}")
+        progress_bar = tqdm(total=len(hrefs), desc=desc, unit="file")
+
+        async def fetch(href):
+            body = await fetch_file(session, bucket, slots, base_url + os.path.basename(href), retries)
+            try:
+                if body is None:
+                    return False
+                await asyncio.to_thread(handle, href, body)
+                return True
+            except Exception as e:
+                logger.error(f"Error saving {href}: {e}")
+                return False
+            finally:
+                progress_bar.update(1)
+
+        try:
+            done = await asyncio.gather(*[fetch(href) for href in hrefs])
+        finally:
+            progress_bar.close()
+    return dict(zip(hrefs, done))
+
+
+def download_new(base_url, handle, **kwargs):
+    """Blocking wrapper of fetch_new."""
+    return asyncio.run(fetch_new(base_url, handle, **kwargs))
@@ -0,0 +1,159 @@
+import os
+import json
+import threading
+
+import numpy as np
+
+try:  # orjson parses the feature collections several times faster; json is the fallback
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+COLUMNS = ("lon", "lat", "Ex", "Ey", "near")  # one float64 array per column, one row per feature
+
+
+def parse_geojson(body):
+    """
+    Parse one E-field feature collection (bytes) straight into arrays: lon and lat from the point
+    coordinates, and Ex, Ey and the nearest station distance from the properties (NaN if absent).
+    Returns {column: (n,) float64 array} in COLUMNS order.
+    """
+    features = loads(body)["features"]
+    coordinates = [(feature.get("geometry") or {}).get("coordinates") or (None, None) for feature in features]
+    properties = [feature.get("properties") or {} for feature in features]
+    xy = np.array([c[:2] for c in coordinates], dtype=np.float64).reshape(-1, 2)
+    return {
+        "lon": xy[:, 0],
+        "lat": xy[:, 1],
+        "Ex": np.array([p.get("Ex") for p in properties], dtype=np.float64),
+        "Ey": np.array([p.get("Ey") for p in properties], dtype=np.float64),
+        "near": np.array([p.get("distance_nearest_station") for p in properties], dtype=np.float64),
+    }
+
+
+class DayStore:
+    """Appendable store of the snapshots of one day, kept in the day's folder.
+
+    Every snapshot is one record on a fixed grid: the (x, y) mesh of the unique coordinates[0] and
+    coordinates[1] values seen so far, flattened x-major like df_to_b3d. Ex and Ey are appended
+    as (n,) float32 vectors to ex.f32 and ey.f32 (NaN where the snapshot has no valid point), and the
+    snapshot time (int64 ns) to time.i8, so a day reads back as two contiguous (nt, n) arrays.
+    grid.npz holds the axes and the nearest-station distances of the earliest snapshot (-1 where
+    missing). A point off the grid widens it and rewrites the day once (the SWPC grids are fixed).
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.paths = {name: os.path.join(folder, name) for name in ("grid.npz", "time.i8", "ex.f32", "ey.f32")}
+        self.x = self.y = self.near = None
+        self.near_time = None
+        if os.path.exists(self.paths["grid.npz"]):
+            with np.load(self.paths["grid.npz"]) as grid:
+                self.x, self.y, self.near = grid["x"], grid["y"], grid["near"]
+                self.near_time = int(grid["near_time"])
+        # Records are written ex, ey, then time: drop whatever an interrupted append left behind
+        sizes = {"time.i8": 8, "ex.f32": 4 * self.n, "ey.f32": 4 * self.n}
+        self.nt = 0
+        if self.n and all(os.path.exists(self.paths[name]) for name in sizes):
+            self.nt = min(os.path.getsize(self.paths[name]) // size for name, size in sizes.items())
+        for name, size in sizes.items():
+            if os.path.exists(self.paths[name]):
+                os.truncate(self.paths[name], self.nt * size)
+
+    @property
+    def n(self):
+        return 0 if self.x is None else len(self.x) * len(self.y)
+
+    def save_grid(self):
+        tmp = self.paths["grid.npz"] + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, x=self.x, y=self.y, near=self.near, near_time=self.near_time)
+        os.replace(tmp, self.paths["grid.npz"])
+
+    def regrid(self, x, y):
+        """Widen the grid to the axes x, y (supersets of the current ones), moving the stored records."""
+        if self.x is not None:
+            j = (np.searchsorted(x, self.x)[:, None] * len(y) + np.searchsorted(y, self.y)[None, :]).ravel()
+            for name in ("ex.f32", "ey.f32"):
+                old = np.fromfile(self.paths[name], dtype=np.float32, count=self.nt * self.n).reshape(self.nt, self.n)
+                new = np.full((self.nt, len(x) * len(y)), np.nan, dtype=np.float32)
+                new[:, j] = old
+                new.tofile(self.paths[name] + ".tmp")
+                os.replace(self.paths[name] + ".tmp", self.paths[name])
+            near = np.full(len(x) * len(y), -1.0)
+            near[j] = self.near
+            self.near = near
+        self.x, self.y = x, y
+        self.save_grid()
+
+    def append(self, time_ns, snapshot):
+        """Append one parsed snapshot (see parse_geojson) taken at `time_ns` (int64 ns since 1970, UTC)."""
+        valid = np.logical_and.reduce([np.isfinite(snapshot[column]) for column in COLUMNS])
+        xs, ys = snapshot["lon"][valid], snapshot["lat"][valid]
+        x, y = np.union1d(xs, self.x if self.x is not None else []), np.union1d(ys, self.y if self.y is not None else [])
+        if self.x is None or len(x) != len(self.x) or len(y) != len(self.y):
+            self.regrid(x, y)
+        j = np.searchsorted(self.x, xs) * len(self.y) + np.searchsorted(self.y, ys)
+        for column, name in (("Ex", "ex.f32"), ("Ey", "ey.f32")):
+            values = np.full(self.n, np.nan, dtype=np.float32)
+            values[j] = snapshot[column][valid]
+            with open(self.paths[name], "ab") as f:
+                f.write(values.tobytes())
+        with open(self.paths["time.i8"], "ab") as f:
+            f.write(np.int64(time_ns).tobytes())
+        self.nt += 1
+        if self.near_time is None or time_ns < self.near_time:
+            self.near = np.full(self.n, -1.0)
+            self.near[j] = snapshot["near"][valid]
+            self.near_time = int(time_ns)
+            self.save_grid()
+
+    def read(self):
+        """(times int64 ns, ex, ey (nt, n) float32) sorted by time; of records with the same time the last appended wins."""
+        times = np.fromfile(self.paths["time.i8"], dtype=np.int64, count=self.nt) if self.nt else np.empty(0, dtype=np.int64)
+        ex, ey = [np.fromfile(self.paths[name], dtype=np.float32, count=self.nt * self.n).reshape(self.nt, self.n) for name in ("ex.f32", "ey.f32")]
+        last = len(times) - 1 - np.unique(times[::-1], return_index=True)[1]
+        if np.array_equal(last, np.arange(len(times))):
+            return times[last], ex, ey  # appended in order without repeats: no copy
+        return times[last], ex[last], ey[last]
+
+
+class DayBuffer:
+    """Snapshots of one feed collected per UTC day as columnar arrays during a run.
+
+    append() is called from the download threads as files arrive; flush() appends them in time
+    order to the DayStore of each day, in data/{typ}/YYYYMMDD/. With `flush_every`, the thread whose
+    append fills the buffer to that many snapshots flushes it, so a killed run loses at most that many.
+    """
+
+    def __init__(self, root, flush_every=None):
+        self.root = root
+        self.flush_every = flush_every
+        self.days = {}
+        self.count = 0
+        self.lock = threading.Lock()
+        self.flushing = threading.Lock()  # one flush at a time: DayStore appends are not thread-safe
+
+    def append(self, date, snapshot):
+        """Add one parsed snapshot (see parse_geojson) taken at `date` (UTC pandas Timestamp)."""
+        with self.lock:
+            self.days.setdefault(date.strftime("%Y%m%d"), []).append((date, snapshot))
+            self.count += 1
+            full = self.flush_every is not None and self.count >= self.flush_every
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Append the buffered snapshots to their day stores and drop them. Returns the store folders written."""
+        with self.flushing:
+            with self.lock:
+                days, self.days, self.count = self.days, {}, 0
+            folders = []
+            for day, snapshots in days.items():
+                store = DayStore(f"{self.root}/{day}")
+                for date, snapshot in sorted(snapshots, key=lambda item: item[0]):
+                    store.append(date.value, snapshot)
+                folders.append(store.folder)
+            return folders
@@ -0,0 +1,125 @@
+# Checks efield_download against a local stand-in for the SWPC listing (no network needed):
+#   python test_efield_download.py      or      python -m pytest test_efield_download.py
+import time
+import socket
+import asyncio
+import threading
+
+from aiohttp import web
+
+import efield_download
+
+NAMES = [f"20250101T00{minute:02d}00-00-ElectricField.json" for minute in range(30)]
+
+
+class StandIn:
+    """aiohttp server in a thread serving a directory listing of NAMES and a small body per file.
+
+    Records the start time of every file request and the most requests in flight at once. The first
+    `slow` file requests take `slow_seconds`; files in `flaky` answer 503 to their first flaky[name] requests.
+    """
+
+    def __init__(self, slow=0, slow_seconds=0, flaky=None, delay=0.02):
+        self.slow, self.slow_seconds, self.delay = slow, slow_seconds, delay
+        self.flaky = dict(flaky or {})
+        self.starts, self.hits, self.log = [], {}, []
+        self.in_flight = self.max_in_flight = 0
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        self.url = f"http://127.0.0.1:{self.port}/data/"
+        threading.Thread(target=asyncio.run, args=(self.serve(),), daemon=True).start()
+        time.sleep(0.3)
+
+    @staticmethod
+    def body(name):
+        return f'{{"features": [], "name": "{name}"}}'.encode()
+
+    async def listing(self, request):
+        links = "".join(f'<a href="{name}">{name}</a>\n' for name in reversed(NAMES))  # not in time order
+        return web.Response(text=f'<html><body><a href="../">../</a>\n{links}</body></html>', content_type="text/html")
+
+    async def handle(self, request):
+        name = request.match_info["name"]
+        self.starts.append(time.monotonic())
+        self.log.append((self.starts[-1], name))
+        self.hits[name] = self.hits.get(name, 0) + 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.slow_seconds if len(self.starts) <= self.slow else self.delay)
+            if self.hits[name] <= self.flaky.get(name, 0):
+                return web.Response(status=503)
+            return web.Response(body=self.body(name))
+        finally:
+            self.in_flight -= 1
+
+    async def serve(self):
+        app = web.Application()
+        app.router.add_get("/data/", self.listing)
+        app.router.add_get("/data/{name}", self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", self.port).start()
+        await asyncio.Event().wait()
+
+
+def most_in_window(starts, window):
+    """Most request starts inside any `window` seconds."""
+    starts = sorted(starts)
+    return max(sum(1 for t in starts[i:] if t < start + window) for i, start in enumerate(starts))
+
+
+def test_concurrency_and_rate_cap():
+    # A server that stalls the first requests: queued files must not bank tokens and burst afterwards
+    server = StandIn(slow=2, slow_seconds=2)
+    per_minute, concurrency = 600, 2
+    bodies = {}
+    results = efield_download.download_new(server.url, bodies.__setitem__, per_minute=per_minute, concurrency=concurrency)
+    assert list(results) == NAMES[:-efield_download.SKIP_NEWEST]  # time order, newest skipped
+    assert all(results.values())
+    assert all(bodies[name] == StandIn.body(name) for name in results)
+    assert server.max_in_flight <= concurrency
+    window = 1.0
+    allowed = efield_download.BURST + (per_minute - efield_download.BURST) / 60 * window + 1  # +1 for timer jitter
+    assert most_in_window(server.starts, window) <= allowed, most_in_window(server.starts, window)
+
+
+def test_retry_backoff():
+    server = StandIn(flaky={NAMES[3]: 2, NAMES[7]: 99})
+    delay, efield_download.RETRY_DELAY = efield_download.RETRY_DELAY, 0.2
+    try:
+        retry_backoff(server)
+    finally:
+        efield_download.RETRY_DELAY = delay
+
+
+def retry_backoff(server):
+    results = efield_download.download_new(server.url, lambda href, body: None, limit=10, per_minute=6000,
+                                           concurrency=4, retries=3)
+    assert list(results) == NAMES[:10]
+    assert server.hits[NAMES[3]] == 3 and results[NAMES[3]]  # two 503s, then the file
+    assert server.hits[NAMES[7]] == 3 and not results[NAMES[7]]  # given up after `retries` attempts
+    assert sum(results.values()) == 9
+    # Jittered doubling: the attempts of file 3 are at least 0.5 * 0.2 s and 0.5 * 0.4 s apart
+    attempts = [t for t, name in server.log if name == NAMES[3]]
+    assert attempts[1] - attempts[0] >= 0.1 and attempts[2] - attempts[1] >= 0.2
+
+
+def test_seen_and_failed_handler():
+    server = StandIn()
+
+    def handle(href, body):
+        if href == NAMES[4]:
+            raise ValueError("bad snapshot")
+
+    results = efield_download.download_new(server.url, handle, seen=set(NAMES[:3]), limit=5, per_minute=6000)
+    assert list(results) == NAMES[3:8]
+    assert sorted(server.hits) == NAMES[3:8]  # files already seen are not requested
+    assert results[NAMES[4]] is False and sum(results.values()) == 4
+
+
+if __name__ == "__main__":
+    for test in [test_concurrency_and_rate_cap, test_retry_backoff, test_seen_and_failed_handler]:
+        test()
+        print(f"{test.__name__}: ok")
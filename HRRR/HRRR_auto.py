@@ -1,20 +1,55 @@
 import os
+import re
 import sys
+import queue
 import struct
+import contextlib
+import shutil
+import weakref
 import warnings
 import concurrent.futures
+from datetime import datetime
 import numpy as np
 import pandas as pd
 import xarray as xr
+import cfgrib
+import eccodes
 from tqdm import tqdm
 from herbie import Herbie
-from multiprocessing import cpu_count
+from quantize import encode_speed, encode_direction, encode_smoke, encode_cpofp
+from governor import ResourceGovernor, run_measured
+from multiprocessing import cpu_count, resource_tracker, shared_memory
 
 warnings.filterwarnings(
     "ignore",
     message="This pattern is interpreted as a regular expression, and has match groups."
 )
 
+# (shortName, level) of every GRIB message matched by REGEX -> variable name used by hrrr_process
+HRRR_FIELDS = {
+    ("2t", 2): "t2m",
+    ("2d", 2): "d2m",
+    ("10u", 10): "u10",
+    ("10v", 10): "v10",
+    ("u", 80): "u",
+    ("v", 80): "v",
+    ("gust", 0): "gust",
+    ("tcc", 0): "tcc",
+    ("sdswrf", 0): "sdswrf",
+    ("dswrf", 0): "sdswrf",  # older eccodes tables
+    ("unknown", 0): "unknown",  # COLMD has no eccodes shortName
+    ("cpofp", 0): "cpofp",
+    ("prate", 0): "prate",
+    ("t", 0): "t",
+}
+# Variable slots of the decoded cube, in order
+HRRR_VARIABLES = list(dict.fromkeys(HRRR_FIELDS.values()))
+
+# Regions cropped out of the CONUS grid at decode time: (min_lon, min_lat, max_lon, max_lat)
+REGIONS = {
+    "TX": (-106.65, 25.84, -93.51, 36.50),
+}
+
 class HiddenPrints:
     """Context manager to suppress stdout (useful for noisy library calls)."""
     def __enter__(self):
@@ -24,55 +59,269 @@ class HiddenPrints:
         sys.stdout.close()
         sys.stdout = self._original_stdout
 
-def get_single_HRRR(date_, fxx_, product, regex, folder):
+def get_subset_file(date_, fxx_, product, regex, folder, quiet=True):
+    """
+    Return the local path of the regex subset GRIB for a single HRRR forecast.
+    The subset is fetched with idx byte-range requests only if it is not on disk yet;
+    the full wrfsfc file is never downloaded.
+    Pass quiet=False from threads: HiddenPrints swaps sys.stdout and is not thread-safe.
+    """
+    with HiddenPrints() if quiet else contextlib.nullcontext():
+        H = Herbie(
+            date_, model="hrrr", product=product, fxx=fxx_, save_dir=folder, verbose=False
+        )
+        path = H.get_localFilePath(regex)
+        if not path.exists():
+            H.download(regex, verbose=False)
+    return path
+
+def get_subset_paths(FH, regex):
+    """
+    Map (run date, fxx) of every Herbie object in a FastHerbie to its local regex subset file.
+    The idx of each file is fetched and parsed once by FastHerbie.download(regex); the decode
+    workers only receive these paths and never look the files up again.
+    """
+    return {(pd.Timestamp(H.date), H.fxx): H.get_localFilePath(regex) for H in FH.objects}
+
+def count_subset_requests(FH, regex):
+    """
+    Number of byte-range requests FastHerbie.download(regex) will make: Herbie fetches each run of
+    consecutive matching messages of a file's index in one request. Reading the inventories fetches
+    the idx files, which Herbie keeps and does not fetch again when downloading.
+    """
+    total = 0
+    for H in FH.objects:
+        messages = H.inventory(regex).grib_message
+        total += int((messages.diff() != 1).sum())
+    return total
+
+def estimate_subset_bytes(FH, regex):
+    """
+    Bytes FastHerbie.download(regex) will pull, from the byte ranges of the files' indexes.
+    The last message of a file has no end byte and counts as the mean size of the others.
+    """
+    total = 0.0
+    for H in FH.objects:
+        inventory = H.inventory(regex)
+        sizes = pd.to_numeric(inventory.end_byte, errors="coerce") - pd.to_numeric(inventory.start_byte, errors="coerce") + 1
+        total += sizes.fillna(sizes.mean()).sum()
+    return int(total)
+
+def get_single_HRRR(date_, fxx_, product, regex, folder, path=None, window=None):
     """
-    Download and process a single HRRR forecast using Herbie.
+    Decode a single HRRR forecast from its regex subset GRIB.
+    Uses `path` when the subset is already on disk, otherwise fetches only the subset.
+    `window` = (y0, y1, x0, x1) crops the grid right after decoding (see crop_window).
     Returns an xarray.Dataset or None if error occurs.
     """
     try:
-        with HiddenPrints():
-            H = Herbie(
-                date_, model="hrrr", product=product, fxx=fxx_, save_dir=folder
-            )
-            # Always download the full file to ensure index is available
-            H.download(verbose=False)
-            ds = H.xarray(regex, remove_grib=False)
-
-            def drop_unwanted_coords(ds):
-                keep_vars = {"valid_time", "latitude", "longitude"}
-                drop_vars = [var for var in ds.coords if var not in keep_vars]
-                return ds.drop_vars(drop_vars)
-
-            ds = [drop_unwanted_coords(d) for d in ds]
-            ds = xr.merge(ds)
-            ds = ds.rename({"x": "lon", "y": "lat"})
-            return ds
+        if path is None or not os.path.exists(path):
+            path = get_subset_file(date_, fxx_, product, regex, folder, quiet=False)
+        ds = cfgrib.open_datasets(str(path), backend_kwargs={"indexpath": ""})
+
+        def drop_unwanted_coords(ds):
+            keep_vars = {"valid_time", "latitude", "longitude"}
+            drop_vars = [var for var in ds.coords if var not in keep_vars]
+            return ds.drop_vars(drop_vars)
+
+        ds = [drop_unwanted_coords(d) for d in ds]
+        ds = xr.merge(ds)
+        ds = ds.rename({"x": "lon", "y": "lat"})
+        if window is not None:
+            y0, y1, x0, x1 = window
+            ds = ds.isel(lat=slice(y0, y1), lon=slice(x0, x1))
+        return ds
+    except Exception as e:
+        print(f"Error in fetching data for {date_} f{fxx_}: {e}")
+        return None
+
+def read_HRRR_grid(path):
+    """
+    Decode the 2D latitude/longitude of the HRRR grid from the first message of a GRIB file.
+    Returns (lat, lon) arrays shaped (y, x).
+    """
+    with open(path, "rb") as f:
+        gid = eccodes.codes_grib_new_from_file(f)
+        try:
+            ny, nx = eccodes.codes_get(gid, "Ny"), eccodes.codes_get(gid, "Nx")
+            lat = eccodes.codes_get_array(gid, "latitudes").reshape(ny, nx)
+            lon = eccodes.codes_get_array(gid, "longitudes").reshape(ny, nx)
+        finally:
+            eccodes.codes_release(gid)
+    return lat, lon
+
+def crop_window(lat, lon, bbox):
+    """
+    Index window (y0, y1, x0, x1) of the smallest grid block that covers every grid point inside
+    bbox = (min_lon, min_lat, max_lon, max_lat) in degrees. lat/lon come from read_HRRR_grid.
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    lon = np.where(lon > 180, lon - 360, lon)
+    inside = (lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)
+    rows = np.flatnonzero(inside.any(axis=1))
+    cols = np.flatnonzero(inside.any(axis=0))
+    if rows.size == 0:
+        raise ValueError(f"bbox {bbox} does not overlap the HRRR grid")
+    return int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+
+def decode_HRRR_messages(path, out, variables=HRRR_VARIABLES, window=None):
+    """
+    Walk the GRIB messages of one subset file with eccodes and write every field listed in
+    HRRR_FIELDS straight into `out`, a (var, y, x) float32 array. Unknown messages are skipped.
+    With `window` = (y0, y1, x0, x1) each field is cropped before it is stored.
+    Returns the valid time as numpy.datetime64.
+    """
+    slots = {name: i for i, name in enumerate(variables)}
+    valid_time = None
+    with open(path, "rb") as f:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(f)
+            if gid is None:
+                break
+            try:
+                name = HRRR_FIELDS.get((eccodes.codes_get(gid, "shortName"), eccodes.codes_get(gid, "level")))
+                if name not in slots:
+                    continue
+                values = eccodes.codes_get_values(gid)
+                if eccodes.codes_get(gid, "bitmapPresent"):
+                    values[values == eccodes.codes_get_double(gid, "missingValue")] = np.nan
+                field = values.reshape(eccodes.codes_get(gid, "Ny"), eccodes.codes_get(gid, "Nx"))
+                if window is not None:
+                    y0, y1, x0, x1 = window
+                    field = field[y0:y1, x0:x1]
+                out[slots[name]] = field
+                if valid_time is None:
+                    stamp = f"{eccodes.codes_get(gid, 'validityDate')}{eccodes.codes_get(gid, 'validityTime'):04d}"
+                    valid_time = np.datetime64(datetime.strptime(stamp, "%Y%m%d%H%M"), "ns")
+            finally:
+                eccodes.codes_release(gid)
+    return valid_time
+
+def decode_shared_HRRR(date_, fxx_, product, regex, folder, path, shm_name, shape, index, window=None,
+                       variables=HRRR_VARIABLES):
+    """
+    Decode a single HRRR forecast with eccodes straight into slot `index` of the shared
+    (valid_time, var, y, x) float32 cube allocated by get_multiple_HRRR.
+    Only the valid time travels back to the parent; returns None if error occurs.
+    """
+    try:
+        if path is None or not os.path.exists(path):
+            path = get_subset_file(date_, fxx_, product, regex, folder, quiet=False)
     except Exception as e:
         print(f"Error in fetching data for {date_} f{fxx_}: {e}")
         return None
+    shm = shared_memory.SharedMemory(name=shm_name)
+    cube = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+    valid_time, error = None, None
+    try:
+        cube[index] = np.nan
+        valid_time = decode_HRRR_messages(path, cube[index], variables, window)
+    except Exception as e:
+        error = str(e)  # keep no traceback (and no view of the cube) alive past this block
+    del cube
+    shm.close()
+    if error is not None:
+        print(f"Error in decoding data for {date_} f{fxx_}: {error}")
+    return valid_time
 
-def get_multiple_HRRR(dates_, fxxs_, product, regex, folder):
+def cube_to_dataset(cube, valid_times, lat, lon, variables=HRRR_VARIABLES):
+    """
+    Wrap a (valid_time, var, y, x) cube in the Dataset layout produced by the cfgrib path,
+    so hrrr_process and NC2PWW work unchanged. The variables are views of the cube.
+    """
+    return xr.Dataset(
+        {name: (("valid_time", "lat", "lon"), cube[:, i]) for i, name in enumerate(variables)},
+        coords={
+            "valid_time": np.asarray(valid_times, dtype="datetime64[ns]"),
+            "latitude": (("lat", "lon"), lat),
+            "longitude": (("lat", "lon"), lon),
+        },
+    )
+
+def pool(governor, executor=None):
+    """The caller's executor, left running, or a new pool from governor that is shut down after use."""
+    return contextlib.nullcontext(executor) if executor is not None else governor.executor()
+
+def get_multiple_HRRR(dates_, fxxs_, product, regex, folder, paths=None, engine="eccodes", governor=None,
+                      bbox=None, window=None, executor=None):
     """
     Download and combine multiple HRRR datasets for a list of dates and forecast hours.
+    `paths` optionally maps (run date, fxx) to subset files already on disk (see get_subset_paths).
+    engine="eccodes" decodes every message straight into one float32 cube in shared memory;
+    engine="cfgrib" builds and merges one xarray.Dataset per file.
+    Workers are sized and throttled by `governor` (a ResourceGovernor from the environment by default).
+    An `executor` made by that governor is used as is instead of a new pool per call, so callers that run
+    several jobs on threads can fork the workers once, before the threads start.
+    A `bbox` (min_lon, min_lat, max_lon, max_lat) or a precomputed index `window` (y0, y1, x0, x1)
+    crops every field to the region right after decoding.
     Returns a sorted, concatenated xarray.Dataset.
     """
-    ds_list = []
-    if len(dates_) > 1:
+    paths = paths or {}
+    governor = governor or ResourceGovernor()
+    if len(dates_) > 1 or np.isscalar(fxxs_):
         # Historical: multiple dates, same forecast hours
-        with concurrent.futures.ProcessPoolExecutor(max_workers=20) as executor:
-            futures = [executor.submit(get_single_HRRR, date_, fxxs_, product, regex, folder) for date_ in dates_]
-            for future in concurrent.futures.as_completed(futures):
-                result = future.result()
-                if result is not None:
-                    ds_list.append(result)
+        tasks = [(date_, fxxs_) for date_ in dates_]
     else:
         # Forecast: single date, multiple forecast hours
-        with concurrent.futures.ProcessPoolExecutor(max_workers=20) as executor:
-            futures = [executor.submit(get_single_HRRR, dates_[0], fxx_, product, regex, folder) for fxx_ in fxxs_]
-            for future in concurrent.futures.as_completed(futures):
-                result = future.result()
-                if result is not None:
-                    ds_list.append(result)
+        tasks = [(dates_[0], fxx_) for fxx_ in fxxs_]
+
+    if engine == "eccodes" or bbox is not None:
+        try:
+            # Grid shape and lat/lon are decoded once, in the parent, from the first subset
+            first = next((p for p in paths.values() if os.path.exists(p)), None)
+            if first is None:
+                first = get_subset_file(tasks[0][0], tasks[0][1], product, regex, folder, quiet=False)
+            lat, lon = read_HRRR_grid(first)
+            if bbox is not None:
+                window = crop_window(lat, lon, bbox)
+        except Exception as e:
+            print(f"Error in reading the HRRR grid: {e}")
+            return None
+        if window is not None:
+            y0, y1, x0, x1 = window
+            lat, lon = lat[y0:y1, x0:x1], lon[y0:y1, x0:x1]
+
+    if engine == "eccodes":
+        shape = (len(tasks), len(HRRR_VARIABLES)) + lat.shape
+        nbytes = int(np.prod(shape)) * np.dtype(np.float32).itemsize
+        if os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").free < nbytes:
+            print(f"Not enough shared memory for {len(tasks)} hours ({nbytes / 1024**3:.1f} GB), raise shm_size")
+            return None
+
+        # Workers decode straight into this cube and only return the valid time
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        cube = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        valid_times = np.full(len(tasks), np.datetime64("NaT", "ns"))
+        try:
+            args = [
+                (date_, fxx_, product, regex, folder, paths.get((pd.Timestamp(date_), fxx_)), shm.name, shape, i, window)
+                for i, (date_, fxx_) in enumerate(tasks)
+            ]
+            with pool(governor, executor) as running:
+                for i, valid_time in governor.run(running, decode_shared_HRRR, args):
+                    if valid_time is not None:
+                        valid_times[i] = valid_time
+        finally:
+            # The mapping stays valid in this process after unlink; close it once the cube is released
+            shm.unlink()
+            weakref.finalize(cube, shm.close)
+
+        ok = ~np.isnat(valid_times)
+        if not ok.any():
+            print("No datasets retrieved.")
+            return None
+        order = np.argsort(valid_times[ok], kind="stable")
+        if not ok.all() or (order != np.arange(order.size)).any():
+            keep = np.flatnonzero(ok)[order]
+            cube, valid_times = cube[keep], valid_times[keep]
+        return cube_to_dataset(cube, valid_times, lat, lon)
+
+    ds_list = []
+    args = [(date_, fxx_, product, regex, folder, paths.get((pd.Timestamp(date_), fxx_)), window) for date_, fxx_ in tasks]
+    with pool(governor, executor) as running:
+        for _, result in governor.run(running, get_single_HRRR, args):
+            if result is not None:
+                ds_list.append(result)
     if ds_list:
         ds_merged = xr.concat(ds_list, dim='valid_time')
         return ds_merged.sortby('valid_time')
@@ -102,25 +351,21 @@ def process_day(day):
 def hrrr_process(ds):
     """
     Process the xarray dataset to convert units and cast data type.
+    Wind, smoke and frozen precipitation are encoded straight to uint8 (see quantize.py).
     Returns processed xarray.Dataset.
     """
-    ds["sped"] = np.sqrt(ds["u10"] ** 2 + ds["v10"] ** 2)
-    ds["sped80"] = np.sqrt(ds["u"] ** 2 + ds["v"] ** 2)
-    ds["drct"] = np.arctan2(ds["u10"], ds["v10"])
+    ds["sped"] = xr.apply_ufunc(encode_speed, ds["u10"], ds["v10"])
+    ds["WindSpeed80mph"] = xr.apply_ufunc(encode_speed, ds["u"], ds["v"])
+    ds["drct"] = xr.apply_ufunc(encode_direction, ds["u10"], ds["v10"])
     ds["t2m"] = np.round((ds["t2m"] - 273.15) * (9 / 5) + 32 + 115)
     ds["d2m"] = np.round((ds["d2m"] - 273.15) * (9 / 5) + 32 + 115)
-    ds["sped"] = np.round(ds["sped"] * 2.23694)
-    ds["WindSpeed80mph"] = np.round(ds["sped80"] * 2.23694)
     ds["gust"] = np.round(ds["gust"] * 2.23694)
     ds["tcc"] = np.round(ds["tcc"])
-    ds["drct"] = np.round(ds["drct"] * 180 / np.pi + 180) / 5
     ds["dswrf"] = ds["sdswrf"] / 5
     ds["dswrf"] = ds["dswrf"].where(ds["dswrf"] >= 0, np.nan)
     ds["prate"] = np.round(ds["prate"] * 3600)
-    ds["colmd"] = np.round(40 * np.log10(ds["unknown"] * 1e6))
-    ds["colmd"] = ds["colmd"].where(ds["colmd"] > 0, 0)
-    ds["cpofp"] = np.round((ds["cpofp"] + 50) * 1 / 1.5)
-    ds['cpofp'] = np.round(ds['cpofp'])
+    ds["colmd"] = xr.apply_ufunc(encode_smoke, ds["unknown"])
+    ds["cpofp"] = xr.apply_ufunc(encode_cpofp, ds["cpofp"])
     if "t" in ds.variables:
         ds["t"] = ds["t"] / 9.81
         alt = ds["t"].isel(valid_time=0).values.astype(int)
@@ -143,44 +388,88 @@ def hrrr_process(ds):
         "WindGust", "PrecipitationRate", "PercentFrozenPrecipitation", "VerticallyIntegratedSmoke"
     ]
     ds = ds[ds_new_columnlist]
-    ds = ds.where(ds < 255, np.nan)
+    # Variables not encoded yet: 255 and above (and NaN) become 255
+    for name in ds_new_columnlist:
+        if ds[name].dtype != np.uint8:
+            ds[name] = ds[name].where(ds[name] < 255, 255).astype("uint8")
     ds = ds.transpose("valid_time", "lat", "lon")
-    ds = ds.fillna(255)
-    ds = ds.astype("uint8")
     return ds
 
-def NC2PWW(ds, file_path):
+# One station record: 18 fixed bytes (which may hold nulls), then three null-terminated strings
+STATION_RECORD = rb".{18}[^\x00]*\x00[^\x00]*\x00[^\x00]*\x00"
+
+def station_records(n):
+    """Pattern matching `n` consecutive station records, so runs of records are skipped in C."""
+    return re.compile(rb"(?:%s){%d}" % (STATION_RECORD, n), re.S)
+
+def crop_station(window, shape, station_file="CONUS_station.pkl"):
     """
-    Convert the xarray dataset to a PWW format and save it.
+    Cut the records of the grid points inside window = (y0, y1, x0, x1) out of a full-grid station
+    file of the given (y, x) shape. Records are in row-major grid order, each one <d lat, <d lon,
+    <h elevation followed by WhoAmI, Country2 and Region as null-terminated strings.
+    Returns the station bytes for the cropped grid.
     """
-    arr = ds.to_array().values
-    arr = arr.transpose(1, 0, 2, 3)
-    DATE = (ds.valid_time.values.astype("int64") + 2209161600 * 10**9) / (10**9 * 86400)
-    aStartDateTimeUTC = DATE.min()
-    aEndDateTimeUTC = DATE.max()
-    COUNT = len(DATE)
-    aMinLat = ds.latitude.values.min()
-    aMaxLat = ds.latitude.values.max()
-    aMinLon = ds.longitude.values.min() - 360
-    aMaxLon = ds.longitude.values.max() - 360
-    LOC = ds.latitude.values.flatten().shape[0]
-    sta = open("CONUS_station.pkl", "rb").read()
-    aPWWFileName = file_path
-    aPWWVersion = 1
-    LOC_FC = 0
-    VARCOUNT = arr.shape[1]
-    with open(aPWWFileName, "wb") as file:
+    data = open(station_file, "rb").read()
+    y0, y1, x0, x1 = window
+    ny, nx = shape
+    row, before, inside = station_records(nx), station_records(x0), station_records(x1 - x0)
+    out = []
+    pos = 0
+    for y in range(y1):
+        if y >= y0:
+            start = before.match(data, pos).end()
+            out.append(data[start:inside.match(data, start).end()])
+        pos = row.match(data, pos).end()
+    return b"".join(out)
+
+# Byte offsets of the header fields PWWWriter patches on close
+PWW_START_OFFSET = 6  # <d aStartDateTimeUTC, followed by <d aEndDateTimeUTC
+PWW_COUNT_OFFSET = 56  # <i COUNT
+
+class PWWWriter:
+    """
+    Write a PWW file one block of hours at a time.
+    The header and station data are written with the first block, each block's uint8 payload is
+    appended in (valid_time, var, lat, lon) order, and the start/end dates and COUNT are patched
+    into the header on close. A single block gives the same bytes as a one-shot write.
+    `station_file` must list the same grid points as the blocks (see crop_station for regional grids).
+    """
+    def __init__(self, file_path, station_file="CONUS_station.pkl"):
+        self.file_path = file_path
+        self.station_file = station_file
+        self.file = None
+        self.count = 0
+        self.start = None
+        self.end = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write_header(self, ds, VARCOUNT):
+        """Write the header and station data, taking dates and COUNT from the first block."""
+        aMinLat = ds.latitude.values.min()
+        aMaxLat = ds.latitude.values.max()
+        aMinLon = ds.longitude.values.min() - 360
+        aMaxLon = ds.longitude.values.max() - 360
+        LOC = ds.latitude.values.flatten().shape[0]
+        sta = open(self.station_file, "rb").read()
+        aPWWVersion = 1
+        LOC_FC = 0
+        file = self.file = open(self.file_path, "wb")
         file.write(struct.pack("<h", 2001))
         file.write(struct.pack("<h", 8065))
         file.write(struct.pack("<h", aPWWVersion))
-        file.write(struct.pack("<d", aStartDateTimeUTC))
-        file.write(struct.pack("<d", aEndDateTimeUTC))
+        file.write(struct.pack("<d", self.start))
+        file.write(struct.pack("<d", self.end))
         file.write(struct.pack("<d", aMinLat))
         file.write(struct.pack("<d", aMaxLat))
         file.write(struct.pack("<d", aMinLon))
         file.write(struct.pack("<d", aMaxLon))
         file.write(struct.pack("<h", 0))
-        file.write(struct.pack("<i", COUNT))
+        file.write(struct.pack("<i", self.count))
         file.write(struct.pack("<i", 3600))
         file.write(struct.pack("<i", LOC))
         file.write(struct.pack("<h", LOC_FC))
@@ -197,9 +486,128 @@ def NC2PWW(ds, file_path):
         file.write(struct.pack("<h", 151))  # PrecipitationRate
         file.write(struct.pack("<h", 150))  # PercentFrozenPrecipitation
         file.write(struct.pack("<h", 122))  # VerticallyIntegratedSmoke
-        file.write(struct.pack("<h", arr.shape[1]))  # BYTECOUNT
+        file.write(struct.pack("<h", VARCOUNT))  # BYTECOUNT
         file.write(sta)
-        file.write(arr.tobytes())
+
+    def append(self, ds):
+        """Append a processed (uint8) dataset block; blocks must arrive in time order."""
+        arr = ds.to_array().values
+        arr = arr.transpose(1, 0, 2, 3)
+        DATE = (ds.valid_time.values.astype("int64") + 2209161600 * 10**9) / (10**9 * 86400)
+        self.start = DATE.min() if self.start is None else min(self.start, DATE.min())
+        self.end = DATE.max() if self.end is None else max(self.end, DATE.max())
+        self.count += len(DATE)
+        if self.file is None:
+            self.write_header(ds, arr.shape[1])
+        self.file.write(arr.tobytes())
+
+    def close(self):
+        """Patch the final dates and COUNT into the header and close the file."""
+        if self.file is None:
+            return
+        self.file.seek(PWW_START_OFFSET)
+        self.file.write(struct.pack("<d", self.start))
+        self.file.write(struct.pack("<d", self.end))
+        self.file.seek(PWW_COUNT_OFFSET)
+        self.file.write(struct.pack("<i", self.count))
+        self.file.close()
+        self.file = None
+
+def NC2PWW(ds, file_path, station_file="CONUS_station.pkl"):
+    """
+    Convert the xarray dataset to a PWW format and save it.
+    `station_file` must list the same grid points as ds (see crop_station for regional grids).
+    """
+    with PWWWriter(file_path, station_file) as writer:
+        writer.append(ds)
+
+def pipeline_HRRR(date_, fxxs_, product, regex, folder, pww_path, station_file="CONUS_station.pkl",
+                  window=None, download_workers=4, queue_size=8, governor=None):
+    """
+    Download, decode and write one HRRR run as a pipeline instead of three sequential stages.
+    Download threads push each finished fxx subset into a bounded queue (so downloads pause when
+    decoding falls behind), the process pool decodes them into a shared cube as they arrive, and
+    hours are encoded and appended to the PWW in fxx order as soon as all earlier hours are done.
+    Returns the number of hours written.
+    """
+    governor = governor or ResourceGovernor()
+    fxxs_ = list(fxxs_)
+    ready = queue.Queue(maxsize=queue_size)
+
+    def download(i, fxx_):
+        try:
+            path = get_subset_file(date_, fxx_, product, regex, folder, quiet=False)
+        except Exception as e:
+            print(f"Error in fetching data for {date_} f{fxx_}: {e}")
+            path = None
+        ready.put((i, path))
+
+    cube = shm = lat = lon = None
+    valid_times = np.full(len(fxxs_), np.datetime64("NaT", "ns"))
+    finished = set()
+    in_flight = {}
+    next_hour = 0
+
+    # The cube is created after the workers fork; start the tracker first so they share it
+    resource_tracker.ensure_running()
+    with governor.executor() as executor, PWWWriter(pww_path, station_file) as writer:
+        executor.submit(int).result()  # start the (forked) workers before any download thread exists
+        downloads = concurrent.futures.ThreadPoolExecutor(max_workers=download_workers)
+
+        def collect(timeout):
+            """Record finished decodes, then encode and append every hour that is next in line."""
+            nonlocal next_hour
+            if in_flight:
+                done, _ = concurrent.futures.wait(in_flight, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    i = in_flight.pop(future)
+                    valid_time, peak_rss = future.result()
+                    governor.record(peak_rss)
+                    if valid_time is not None:
+                        valid_times[i] = valid_time
+                    finished.add(i)
+            while next_hour in finished:
+                if not np.isnat(valid_times[next_hour]):
+                    hour = cube_to_dataset(cube[next_hour:next_hour + 1], valid_times[next_hour:next_hour + 1], lat, lon)
+                    writer.append(hrrr_process(hour))
+                next_hour += 1
+
+        try:
+            for i, fxx_ in enumerate(fxxs_):
+                downloads.submit(download, i, fxx_)
+            for _ in fxxs_:
+                while len(in_flight) >= governor.pool_size or in_flight and not governor.has_room():
+                    collect(timeout=None)
+                while True:
+                    try:
+                        i, path = ready.get(timeout=0.5)
+                        break
+                    except queue.Empty:
+                        collect(timeout=0)
+                if path is None:
+                    finished.add(i)
+                    continue
+                if cube is None:
+                    # Allocate the shared cube from the first subset that lands
+                    lat, lon = read_HRRR_grid(path)
+                    if window is not None:
+                        y0, y1, x0, x1 = window
+                        lat, lon = lat[y0:y1, x0:x1], lon[y0:y1, x0:x1]
+                    shape = (len(fxxs_), len(HRRR_VARIABLES)) + lat.shape
+                    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(np.float32).itemsize)
+                    cube = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+                future = executor.submit(run_measured, decode_shared_HRRR, date_, fxxs_[i], product, regex, folder,
+                                         path, shm.name, shape, i, window)
+                in_flight[future] = i
+            while in_flight or next_hour < len(fxxs_) and next_hour in finished:
+                collect(timeout=None)
+        finally:
+            downloads.shutdown(wait=True)
+            if shm is not None:
+                del cube
+                shm.close()
+                shm.unlink()
+        return writer.count
 
 if __name__ == "__main__":
     # Example usage: fetch one day of data
@@ -13,26 +13,23 @@ import time
 import logging
 from datetime import datetime, timedelta
 
-import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
-from herbie import Herbie, FastHerbie
 from HRRR_auto import (
-    HiddenPrints,
-    get_multiple_HRRR,
-    get_single_HRRR,
-    hrrr_process,
-    NC2PWW,
+    get_subset_file,
+    pipeline_HRRR,
+    read_HRRR_grid,
+    crop_window,
+    crop_station,
+    REGIONS,
 )
 from helper import helper
+from cycle_watch import latest_cycle, wait_for, hrrr_idx_url
 
 from pydrive2.auth import GoogleAuth
 from pydrive2.drive import GoogleDrive
 
-from datetime import datetime, timedelta
-import pandas as pd
-import os
+
 # =========================
 # Configuration and Globals
 # =========================
@@ -48,10 +45,14 @@ os.makedirs(DATA_DIR, exist_ok=True)
 
 # Herbie/HRRR configuration
 PRODUCT = "sfc"
-STATE = "TX"  # US for CONUS
+STATE = "TX"  # US for CONUS; states listed in REGIONS are cropped at decode time
 REGEX = r":(?:TMP|DPT|UGRD|VGRD|TCDC|DSWRF|COLMD|GUST|CPOFP|PRATE):((2|8|10|80) m above|entire atmosphere|surface|entire atmosphere single layer)"
 # REGEX = r":(?:TMP|DPT|UGRD|VGRD|TCDC|DSWRF|COLMD|GUST|CPOFP|PRATE):(?:(?:2|8|10|80) m above ground|entire atmosphere|surface|entire atmosphere \(considered as a single layer\))"
 
+FXXS = list(range(1, 49))
+HRRR_READY_AFTER = timedelta(hours=1, minutes=45)  # f48 of a run is usually listed 1h45 to 2h after the run time
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 4))  # concurrent subset downloads feeding the decoders
+
 GRIB_FOLDER = os.path.join(DATA_DIR, "grib")
 NC_FOLDER = os.path.join(DATA_DIR, "nc")
 PWW_DAILY_FOLDER = os.path.join(DATA_DIR, "pww", "daily")
@@ -87,8 +88,6 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-
-
 # =========================
 # Utility Functions
 # =========================
@@ -122,24 +121,26 @@ def get_target_dates(meta_file, lag_days):
 
     return pending_dates, meta
 
+def get_region_station(state, window, shape):
+    """Return the station file of a cropped region, cutting it out of CONUS_station.pkl the first time."""
+    station_file = f"{state}_{'_'.join(map(str, window))}_station.pkl"
+    if not os.path.exists(station_file):
+        logger.info(f"Creating {station_file} for grid window {window}")
+        with open(station_file, "wb") as f:
+            f.write(crop_station(window, shape))
+    return station_file
+
 # =========================
 # Main Processing Function
 # =========================
 
 
-
-
 def main():
     """Main data fetching and processing routine."""
     ensure_directories()
 
-    # Get today's 12Z
-    now = datetime.now()
-    target_date = now.replace(hour=12, minute=0, second=0, microsecond=0)
-    
-    # If it's before 12Z today, use yesterday's 12Z
-    if now.hour < 12:
-        target_date -= timedelta(days=1)
+    # Latest 12Z run whose f48 can be out by now (days are shifted so each one starts at 12Z)
+    target_date = (latest_cycle(24, timedelta(hours=12) + HRRR_READY_AFTER) + timedelta(hours=12)).replace(tzinfo=None)
     
     date_iso = target_date.strftime("%Y-%m-%dT12:00:00")
     pww_date = target_date.strftime("%Y-%m-%dT12Z")
@@ -160,25 +161,32 @@ def main():
     drive = GoogleDrive(gauth)
     hp = helper(logger)
 
+    # Start as soon as the last forecast hour is listed instead of assuming it is there
+    wait_for(hrrr_idx_url(target_date, FXXS[-1], PRODUCT), logger=logger)
+
     # Process single date
     try:
-        # Download gribs data
-        H = FastHerbie(
-            [date_iso],
-            model="hrrr",
-            product=PRODUCT,
-            fxx=range(1, 49),
-            save_dir=GRIB_FOLDER,
+        # The first subset fixes the grid (and the region window) before the pipeline starts
+        first = get_subset_file(date_iso, FXXS[0], PRODUCT, REGEX, GRIB_FOLDER)
+        window, station_file = None, "CONUS_station.pkl"
+        if STATE in REGIONS:
+            # Crop every field to the region right after decoding
+            lat, lon = read_HRRR_grid(first)
+            window = crop_window(lat, lon, REGIONS[STATE])
+            station_file = get_region_station(STATE, window, lat.shape)
+
+        # Download, decode and write overlap: hours are decoded as their subsets land
+        # and appended to the PWW in fxx order
+        file_name = f"{pww_date}_{PRODUCT}_48_{STATE}.pww"
+        hours = pipeline_HRRR(
+            date_iso, FXXS, PRODUCT, REGEX, GRIB_FOLDER,
+            os.path.join(PWW_DAILY_FOLDER, file_name), station_file, window=window,
+            download_workers=DOWNLOAD_WORKERS,
         )
-        H.download(REGEX)
-        
-        # Process and save
-        ds = get_multiple_HRRR([date_iso], list(range(1, 49)), PRODUCT, REGEX, GRIB_FOLDER)
-        ds = hrrr_process(ds)
+        if hours == 0:
+            raise RuntimeError(f"no forecast hours decoded for {date_iso}")
+        logger.info(f"Wrote {hours}/{len(FXXS)} forecast hours")
 
-        file_name = f"{pww_date}_{PRODUCT}_48_{STATE}.pww"
-        NC2PWW(ds, os.path.join(PWW_DAILY_FOLDER, file_name))
-        
         zip_file = os.path.join(ZIP_FOLDER, f"{pww_date}_{PRODUCT}_48_{STATE}.zip")
         hp.zip_file(os.path.join(PWW_DAILY_FOLDER, file_name), zip_file, remove=False)
 
@@ -202,13 +210,5 @@ def main():
     meta.to_csv(meta_file, index=False)
 
 
-
-
-
-
-
-
-
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,156 @@
+import os
+import logging
+import concurrent.futures
+
+import psutil
+
+
+class ResourceGovernor:
+    """Size process pools from the container's CPU and memory limits and throttle task submission.
+
+    The worker count is the smallest of MAX_WORKERS, the CPUs available to the cgroup, and the
+    workers that fit in available memory at the measured per-task peak RSS. While tasks run,
+    new ones are only submitted when available memory stays above MIN_AVAILABLE_GB.
+
+    Limits come from the arguments, else from the environment (see docker-compose.yml):
+        MAX_WORKERS       hard cap on workers (default 20)
+        TASK_MEMORY_GB    per-task peak RSS assumed until one is measured (default 1.5)
+        MIN_AVAILABLE_GB  memory kept free for the parent and the OS (default 2)
+        RESERVE_CORES     cores left free for the parent (default 0)
+    """
+
+    def __init__(self, max_workers=None, task_memory_gb=None, min_available_gb=None, reserve_cores=None, logger=None):
+        self.max_workers = int(max_workers or os.environ.get("MAX_WORKERS", 20))
+        self.task_memory = float(task_memory_gb or os.environ.get("TASK_MEMORY_GB", 1.5)) * 1024**3
+        self.min_available = float(min_available_gb or os.environ.get("MIN_AVAILABLE_GB", 2)) * 1024**3
+        self.reserve_cores = int(reserve_cores or os.environ.get("RESERVE_CORES", 0))
+        self.logger = logger or logging.getLogger(__name__)
+        self.peak_rss = 0  # largest per-task peak RSS measured so far
+        self.pool_size = self.max_workers
+
+    def available_cpus(self):
+        """CPUs this process may use: affinity mask capped by the cgroup CPU quota."""
+        try:
+            cpus = len(os.sched_getaffinity(0))
+        except AttributeError:
+            cpus = os.cpu_count() or 1
+        quota = None
+        try:
+            with open("/sys/fs/cgroup/cpu.max") as f:  # cgroup v2: "<quota> <period>" or "max <period>"
+                limit, period = f.read().split()
+                if limit != "max":
+                    quota = int(limit) / int(period)
+        except (OSError, ValueError):
+            try:
+                with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:  # cgroup v1
+                    limit = int(f.read())
+                with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                    period = int(f.read())
+                if limit > 0:
+                    quota = limit / period
+            except (OSError, ValueError):
+                pass
+        if quota is not None:
+            cpus = min(cpus, max(1, int(quota)))
+        return cpus
+
+    def available_memory(self):
+        """Bytes of memory available: host available memory capped by the cgroup limit headroom."""
+        available = psutil.virtual_memory().available
+        for limit_file, usage_file in [
+            ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),  # cgroup v2
+            ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes"),  # v1
+        ]:
+            try:
+                with open(limit_file) as f:
+                    limit = f.read().strip()
+                with open(usage_file) as f:
+                    usage = int(f.read())
+            except (OSError, ValueError):
+                continue
+            if limit.isdigit() and int(limit) < 2**60:
+                available = min(available, int(limit) - usage)
+            break
+        return max(0, available)
+
+    def task_size(self):
+        """Per-task memory estimate: the measured peak RSS once there is one."""
+        return self.peak_rss or self.task_memory
+
+    def workers(self):
+        """Number of workers to start for a pool."""
+        by_cpu = max(1, self.available_cpus() - self.reserve_cores)
+        by_memory = max(1, int((self.available_memory() - self.min_available) // self.task_size()))
+        workers = max(1, min(self.max_workers, by_cpu, by_memory))
+        self.logger.info(
+            f"Using {workers} workers (CPUs: {by_cpu}, memory allows: {by_memory}, "
+            f"available RAM: {self.available_memory() / 1024**3:.1f}GB, cap: {self.max_workers})"
+        )
+        return workers
+
+    def has_room(self):
+        """True if one more task fits above the memory floor."""
+        return self.available_memory() - self.task_size() >= self.min_available
+
+    def record(self, peak_rss):
+        """Fold a measured per-task peak RSS into the estimate."""
+        if peak_rss:
+            self.peak_rss = max(self.peak_rss, peak_rss)
+
+    def executor(self, executor_class=concurrent.futures.ProcessPoolExecutor):
+        """Create a pool sized by workers(); pass it to run()."""
+        self.pool_size = self.workers()
+        return executor_class(max_workers=self.pool_size)
+
+    def run(self, executor, fn, tasks):
+        """
+        Run fn(*args) for every args tuple in tasks on an executor made by executor(), keeping
+        at most one task per worker submitted and holding back new ones while memory is low.
+        Yields (index, result) in completion order.
+        """
+        max_in_flight = self.pool_size
+        tasks = iter(enumerate(tasks))
+        pending = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_in_flight:
+                if pending and not self.has_room():
+                    self.logger.warning(
+                        f"Low memory ({self.available_memory() / 1024**3:.1f}GB available), "
+                        f"holding back tasks with {len(pending)} in flight"
+                    )
+                    break
+                try:
+                    i, args = next(tasks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(run_measured, fn, *args)] = i
+            if not pending:
+                return
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                result, peak_rss = future.result()
+                self.record(peak_rss)
+                yield i, result
+
+
+def run_measured(fn, *args):
+    """Run fn(*args) in a worker and return (result, peak RSS in bytes of this task)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")  # reset VmHWM so it covers this task only
+    except OSError:
+        pass
+    result = fn(*args)
+    peak_rss = None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    peak_rss = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        peak_rss = psutil.Process().memory_info().rss
+    return result, peak_rss
@@ -10,6 +10,8 @@ import os
 import sys
 import time
 import logging
+import threading
+from multiprocessing import resource_tracker
 from datetime import datetime, timedelta
 
 import numpy as np
@@ -21,10 +23,15 @@ from HRRR_auto import (
     HiddenPrints,
     get_multiple_HRRR,
     get_single_HRRR,
+    count_subset_requests,
+    estimate_subset_bytes,
+    get_subset_paths,
     hrrr_process,
     NC2PWW,
 )
+from governor import ResourceGovernor
 from helper import helper
+from backfill import RateLimiter, run_backfill, scratch_dir
 
 from pydrive2.auth import GoogleAuth
 from pydrive2.drive import GoogleDrive
@@ -55,6 +62,16 @@ GRIB_FOLDER = os.path.join(DATA_DIR, "grib")
 NC_FOLDER = os.path.join(DATA_DIR, "nc")
 PWW_DAILY_FOLDER = os.path.join(DATA_DIR, "pww", "daily")
 ZIP_FOLDER = os.path.join(DATA_DIR, "zip")
+FXXS = list(range(1, 49))
+
+# Dates are backfilled BACKFILL_JOBS at a time under one download budget (see backfill.py),
+# each downloading into its own scratch folder under GRIB_FOLDER that is removed afterwards.
+# Only DECODE_JOBS jobs decode at once since each decode pool already uses every core
+BACKFILL_JOBS = int(os.environ.get("BACKFILL_JOBS", 3))
+DECODE_SLOTS = threading.BoundedSemaphore(int(os.environ.get("DECODE_JOBS", 1)))
+# HTTP requests Herbie makes to locate one subset before its byte ranges: a HEAD for the GRIB,
+# a HEAD for its idx (both on the first source that has it) and a GET of the idx
+LOOKUP_REQUESTS = 3
 
 # =========================
 # Logging Setup
@@ -120,6 +137,45 @@ def get_historical_dates(start_date, end_date, meta_file):
     
     return pending_dates, meta
 
+def process_date(target_date, rate_limiter, hp, governor=None, executor=None):
+    """
+    Download, decode and zip the 48-hour forecast of one historical run in a scratch folder.
+    Every HTTP request (LOOKUP_REQUESTS per subset, then one per byte range) is charged to the
+    shared rate_limiter budget, and the subset bytes before they are fetched; decoding runs on `executor`
+    (see get_multiple_HRRR). Returns the zip path, or None on failure.
+    """
+    # Create date strings using MODEL_HOUR variable
+    date_iso = target_date.strftime("%Y-%m-%d") + f"T{MODEL_HOUR}:00:00"
+    pww_date = target_date.strftime(f"%Y-%m-%dT{MODEL_HOUR}Z")
+
+    try:
+        with scratch_dir(GRIB_FOLDER, target_date.strftime("%Y%m%d")) as save_dir:
+            # Download, charging the shared request and bandwidth budget
+            rate_limiter.acquire(len(FXXS) * LOOKUP_REQUESTS)
+            H = FastHerbie([date_iso], model="hrrr", product=PRODUCT, fxx=FXXS, save_dir=save_dir)
+            expected = estimate_subset_bytes(H, REGEX)
+            rate_limiter.acquire(count_subset_requests(H, REGEX), expected)
+            H.download(REGEX)
+            paths = get_subset_paths(H, REGEX)
+            rate_limiter.consume(sum(os.path.getsize(p) for p in paths.values() if os.path.exists(p)) - expected)
+
+            with DECODE_SLOTS:
+                ds = get_multiple_HRRR([date_iso], FXXS, PRODUCT, REGEX, save_dir, paths,
+                                       governor=governor, executor=executor)
+                ds = hrrr_process(ds)
+
+                file_name = f"{pww_date}_{PRODUCT}_48_{STATE}.pww"
+                NC2PWW(ds, os.path.join(PWW_DAILY_FOLDER, file_name))
+                del ds
+
+        zip_file = os.path.join(ZIP_FOLDER, f"{pww_date}_{PRODUCT}_48_{STATE}.zip")
+        hp.zip_file(os.path.join(PWW_DAILY_FOLDER, file_name), zip_file, remove=False)
+        logger.info(f"Processed historical {file_name}")
+        return zip_file
+    except Exception as e:
+        logger.error(f"Failed to process {date_iso}: {e}")
+        return None
+
 # =========================
 # Main Processing Function
 # =========================
@@ -143,52 +199,26 @@ def main():
     
     logger.info(f"Found {len(dates)} historical dates to process")
     
-    # Process in batches (don't overwhelm NOAA servers)
-    BATCH_SIZE = 5  # Process 5 days at a time
-    
-    for i in range(0, len(dates), BATCH_SIZE):
-        batch = dates[i:i+BATCH_SIZE]
-        logger.info(f"Processing batch {i//BATCH_SIZE + 1}: {len(batch)} dates")
-        
-        for target_date in tqdm(batch, desc=f"Batch {i//BATCH_SIZE + 1}"):
-            # Create date strings using MODEL_HOUR variable
-            date_iso = target_date.strftime("%Y-%m-%d") + f"T{MODEL_HOUR}:00:00"
-            pww_date = target_date.strftime(f"%Y-%m-%dT{MODEL_HOUR}Z")
-            
-            try:
-                # Download and process
-                H = FastHerbie([date_iso], model="hrrr", product=PRODUCT, fxx=range(1, 49), save_dir=GRIB_FOLDER)
-                H.download(REGEX)
-                ds = get_multiple_HRRR([date_iso], list(range(1, 49)), PRODUCT, REGEX, GRIB_FOLDER)
-                ds = hrrr_process(ds)
-                
-                file_name = f"{pww_date}_{PRODUCT}_48_{STATE}.pww"
-                NC2PWW(ds, os.path.join(PWW_DAILY_FOLDER, file_name))
-                
-                zip_file = os.path.join(ZIP_FOLDER, f"{pww_date}_{PRODUCT}_48_{STATE}.zip")
-                hp.zip_file(os.path.join(PWW_DAILY_FOLDER, file_name), zip_file, remove=False)
-                
-                status = True
-                logger.info(f"Processed historical {file_name}")
-                
-            except Exception as e:
-                logger.error(f"Failed to process {date_iso}: {e}")
-                status = False
-            
+    # Several dates at a time under one download budget (don't overwhelm NOAA servers)
+    rate_limiter = RateLimiter()
+    governor = ResourceGovernor(logger=logger)
+    # Workers attach to the decode cubes in shared memory: they must share this process's tracker
+    resource_tracker.ensure_running()
+    with governor.executor() as executor:
+        executor.submit(int).result()  # start the (forked) workers before the job threads exist
+        jobs = run_backfill(dates, lambda d: process_date(d, rate_limiter, hp, governor, executor),
+                            BACKFILL_JOBS, logger, desc="HRRR backfill")
+        for target_date, zip_file in jobs:
+            status = zip_file is not None
+
             # Update meta
             meta = pd.concat([meta, pd.DataFrame({"date": [target_date], "status": [status]})], ignore_index=True)
             meta = meta.drop_duplicates(subset="date", keep="last")
             meta.to_csv(meta_file, index=False)
-            
-            # Rate limiting - be nice to NOAA servers
-            time.sleep(2)
-        
-        # Upload batch to drive
-        hp.upload_to_drive(drive, "1zl-xxQHVB0lqvum_eVZnIpizDvAaq1N7", os.path.join(ZIP_FOLDER, "*.zip"))
-        
-        # Optional: Clean up local files after upload to save space
-        # shutil.rmtree(GRIB_FOLDER)
-        # os.makedirs(GRIB_FOLDER, exist_ok=True)
+
+            # Upload to drive as each date finishes
+            if status:
+                hp.upload_to_drive(drive, "1zl-xxQHVB0lqvum_eVZnIpizDvAaq1N7", zip_file)
 
 if __name__ == "__main__":
     main()
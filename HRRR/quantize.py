@@ -0,0 +1,177 @@
+import sys
+import time
+import itertools
+
+import numpy as np
+
+
+# =========================
+# Encoders
+# =========================
+# Each encoder maps raw float32 fields straight to the uint8 PWW codes in one call. Each one is
+# the exact float32 operation chain hrrr_process used to run, including its final step where
+# values of 255 and above and NaN become 255, then uint8.
+
+def pww_code(v):
+    """Final step of hrrr_process: values >= 255 and NaN become 255, then cast to uint8."""
+    return np.where(v < 255, v, 255).astype(np.uint8)
+
+def smoke_reference(unknown):
+    """VerticallyIntegratedSmoke from the COLMD field (kg/m^2)."""
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        colmd = np.round(40 * np.log10(unknown * 1e6))
+    return pww_code(np.where(colmd > 0, colmd, 0))
+
+def encode_speed(u, v):
+    """Wind speed in mph from the u/v components (m/s)."""
+    return pww_code(np.round(np.sqrt(u ** 2 + v ** 2) * 2.23694))
+
+def encode_direction(u, v):
+    """WindDirection in 5 degree steps (the uint8 cast truncates the fifths) from the u/v components."""
+    return pww_code(np.round(np.arctan2(u, v) * 180 / np.pi + 180) / 5)
+
+def encode_cpofp(cpofp):
+    """PercentFrozenPrecipitation from CPOFP (%, -50 where there is no precipitation)."""
+    return pww_code(np.round((cpofp + 50) * 1 / 1.5))
+
+
+# =========================
+# Lookup-table encoder
+# =========================
+
+BUCKET_SHIFT = 12  # a bucket is 4096 consecutive float32 bit patterns (~0.05% of the value)
+
+def float_keys(x):
+    """Map float32 values to int64 keys that sort in the same order (-0.0 and 0.0 share a key)."""
+    i = np.asarray(x, dtype=np.float32).view(np.int32).astype(np.int64)
+    return np.where(i >= 0, i, -(i & 0x7FFFFFFF))
+
+def key_floats(k):
+    """Inverse of float_keys."""
+    k = np.asarray(k, dtype=np.int64)
+    return np.where(k >= 0, k, -k + 0x80000000).astype(np.uint32).view(np.float32)
+
+class LUTEncoder:
+    """Encode a float32 field to uint8 codes with lookup tables instead of its transcendental chain.
+
+    `reference` must be non-decreasing over the float32 values in [lo, hi]. Its breakpoints (the
+    first float of every code) are found by bisecting over the float32 values themselves. Then
+    np.searchsorted places them in buckets of consecutive bit patterns. Each bucket stores the code
+    of its smallest value and the breakpoint inside it. Encoding costs two table lookups and one
+    comparison per value, and gives exactly the code the reference does. Buckets outside the
+    domain, holding NaN/inf or holding more than one breakpoint go through the reference.
+    """
+
+    def __init__(self, name, reference, lo=-np.finfo(np.float32).max, hi=np.finfo(np.float32).max):
+        self.name = name
+        self.reference = reference
+        self.lo = np.float32(lo)
+        self.hi = np.float32(hi)
+        key_lo, key_hi = float_keys([self.lo, self.hi])
+        code_lo, code_hi = reference(key_floats([key_lo, key_hi])).astype(np.int64)
+        # For every code above code_lo, the first float whose code is >= it
+        targets = np.arange(code_lo + 1, code_hi + 1)
+        low = np.full(targets.size, key_lo)
+        high = np.full(targets.size, key_hi)
+        while (high - low > 1).any():
+            mid = (low + high) // 2
+            above = reference(key_floats(mid)).astype(np.int64) >= targets
+            high = np.where(above, mid, high)
+            low = np.where(above, low, mid)
+        self.breaks = key_floats(high)
+
+        buckets = np.arange(1 << (32 - BUCKET_SHIFT), dtype=np.uint64) << BUCKET_SHIFT
+        first = buckets.astype(np.uint32).view(np.float32)
+        last = (buckets + (1 << BUCKET_SHIFT) - 1).astype(np.uint32).view(np.float32)
+        with np.errstate(invalid="ignore"):
+            smallest = np.minimum(first, last)  # bit order runs backwards for negative floats
+            largest = np.maximum(first, last)
+            inside = (smallest >= self.lo) & (largest <= self.hi)
+        below = np.searchsorted(self.breaks, smallest, side="right")
+        n_breaks = np.searchsorted(self.breaks, largest, side="right") - below
+        self.base = np.where(inside, reference(smallest), 0).astype(np.uint8)
+        self.thresholds = np.full(buckets.size, np.inf, dtype=np.float32)
+        one = inside & (n_breaks == 1)
+        self.thresholds[one] = self.breaks[below[one]]
+        self.thresholds[~inside | (n_breaks > 1)] = np.nan  # NaN marks buckets left to the reference
+
+    def encode(self, x):
+        """uint8 codes of x, identical to reference(x)."""
+        x = np.asarray(x)
+        if x.dtype != np.float32:
+            return self.reference(x)
+        bucket = x.view(np.uint32) >> BUCKET_SHIFT
+        threshold = self.thresholds[bucket]
+        codes = self.base[bucket]
+        codes += x >= threshold
+        fallback = np.isnan(threshold)
+        if fallback.any():
+            codes[fallback] = self.reference(x[fallback])
+        return codes
+
+    __call__ = encode
+
+# Negative and zero COLMD encode to 0 like the smallest positive values, so the domain is every finite float
+encode_smoke = LUTEncoder("VerticallyIntegratedSmoke", smoke_reference)
+
+
+# =========================
+# Validation harness
+# =========================
+
+def validate(encoder, samples=10**7, exhaustive=False, values=None, seed=0):
+    """
+    Compare encoder.encode with encoder.reference and return the number of mismatches.
+    Checks every breakpoint +-64 ulps, special values, `samples` random float32 bit patterns,
+    `values` (e.g. a decoded field) and, if exhaustive, every float32 in the encoder's domain.
+    """
+    rng = np.random.default_rng(seed)
+    keys = float_keys(encoder.breaks)
+    near = (keys[:, None] + np.arange(-64, 65)).ravel()
+    special = np.array([0.0, -0.0, np.inf, -np.inf, np.nan, encoder.lo, encoder.hi, -1, 1, 1e-30, 1e30], dtype=np.float32)
+    checks = [
+        ("breakpoints", key_floats(near)),
+        ("special", special),
+        ("random", rng.integers(0, 2**32, samples, dtype=np.uint64).astype(np.uint32).view(np.float32)),
+    ]
+    if values is not None:
+        checks.append(("field", np.asarray(values, dtype=np.float32).ravel()))
+    if exhaustive:
+        key_lo, key_hi = float_keys([encoder.lo, encoder.hi])
+        chunk = 2**24
+        # Generated chunk by chunk: all 2**32 floats would not fit in memory at once
+        checks = itertools.chain(checks, (("exhaustive", key_floats(np.arange(k, min(k + chunk, key_hi + 1))))
+                                          for k in range(int(key_lo), int(key_hi) + 1, chunk)))
+
+    mismatches = 0
+    for label, x in checks:
+        bad = np.flatnonzero(encoder.encode(x) != encoder.reference(x))
+        if bad.size:
+            mismatches += bad.size
+            print(f"  {label}: {bad.size} mismatches, e.g. {x[bad[:3]]}")
+    print(f"{encoder.name}: {len(encoder.breaks)} breakpoints, {mismatches} mismatches"
+          + (" (exhaustive)" if exhaustive else ""))
+    return mismatches
+
+def benchmark(encoder, values, repeat=5):
+    """Seconds per call of reference and LUT encoding of `values`."""
+    values = np.asarray(values, dtype=np.float32)
+    timings = []
+    for fn in [encoder.reference, encoder.encode]:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn(values)
+        timings.append((time.perf_counter() - start) / repeat)
+    print(f"{encoder.name}: reference {timings[0] * 1e3:.1f} ms, LUT {timings[1] * 1e3:.1f} ms per {values.size} values")
+    return timings
+
+
+if __name__ == "__main__":
+    # python quantize.py [--exhaustive]
+    exhaustive = "--exhaustive" in sys.argv
+    rng = np.random.default_rng(1)
+    colmd = rng.lognormal(np.log(2e-6), 2, 1059 * 1799).astype(np.float32)  # one CONUS hour
+    colmd[rng.random(colmd.size) < 0.1] = 0
+    failed = validate(encode_smoke, values=colmd, exhaustive=exhaustive)
+    benchmark(encode_smoke, colmd)
+    sys.exit(1 if failed else 0)
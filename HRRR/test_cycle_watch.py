@@ -0,0 +1,94 @@
+# Checks cycle_watch against a local stand-in for the index listings (no network needed):
+#   python test_cycle_watch.py      or      python -m pytest test_cycle_watch.py
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cycle_watch
+
+
+class StandIn:
+    """HTTP server in a thread answering HEAD requests for index files.
+
+    A path in `appear_after` answers 404 to its first appear_after[path] requests and 200 after;
+    any other path is always missing. Records the time of every request per path.
+    """
+
+    def __init__(self, appear_after=None):
+        self.appear_after = dict(appear_after or {})
+        self.log = {}
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                hits = stand_in.log.setdefault(self.path, [])
+                hits.append(time.monotonic())
+                found = self.path in stand_in.appear_after and len(hits) > stand_in.appear_after[self.path]
+                self.send_response(200 if found else 404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def path(self, url):
+        return url[len(self.base):]
+
+
+def test_latest_cycle():
+    now = datetime(2025, 3, 1, 10, 30, tzinfo=timezone.utc)
+    # GFS every 6 h, last step ready ~5 h after the cycle: 05:30 falls in the 00Z cycle
+    assert cycle_watch.latest_cycle(6, timedelta(hours=5), now) == datetime(2025, 3, 1, 0, tzinfo=timezone.utc)
+    assert cycle_watch.latest_cycle(6, timedelta(hours=4), now) == datetime(2025, 3, 1, 6, tzinfo=timezone.utc)
+    # HRRR hourly; across midnight the previous day's cycle is returned
+    assert cycle_watch.latest_cycle(1, timedelta(hours=2), now) == datetime(2025, 3, 1, 8, tzinfo=timezone.utc)
+    assert cycle_watch.latest_cycle(6, timedelta(hours=11), now) == datetime(2025, 2, 28, 18, tzinfo=timezone.utc)
+
+
+def test_index_urls():
+    run = datetime(2025, 3, 1, 6, tzinfo=timezone.utc)
+    assert cycle_watch.gfs_idx_url("20250301", "06", 384, base="B") == "B/gfs.20250301/06/atmos/gfs.t06z.pgrb2.0p25.f384.idx"
+    assert cycle_watch.hrrr_idx_url(run, 18, base="B") == "B/hrrr.20250301/conus/hrrr.t06z.wrfsfcf18.grib2.idx"
+
+
+def test_available():
+    server = StandIn({"/present": 0})
+    assert cycle_watch.available(server.base + "/present")
+    assert not cycle_watch.available(server.base + "/missing")
+    server.server.shutdown()
+    server.server.server_close()
+    assert not cycle_watch.available(server.base + "/present", timeout=1)  # connection refused is not available
+
+
+def test_poll_backoff():
+    server = StandIn()
+    url = cycle_watch.hrrr_idx_url(datetime(2025, 3, 1, 6), 18, base=server.base)
+    server.appear_after[server.path(url)] = 4
+    assert cycle_watch.wait_for(url, max_wait_hours=1, poll_seconds=0.1, max_poll_seconds=0.3)
+    hits = server.log[server.path(url)]
+    assert len(hits) == 5  # four misses, then the file
+    gaps = [b - a for a, b in zip(hits, hits[1:])]
+    # Jittered doubling (+-20%) capped at max_poll_seconds: 0.1, 0.2, 0.3, 0.3
+    for gap, delay in zip(gaps, [0.1, 0.2, 0.3, 0.3]):
+        assert 0.8 * delay <= gap <= 1.2 * delay + 0.1, gaps
+
+
+def test_timeout():
+    server = StandIn()
+    url = cycle_watch.gfs_idx_url("20250301", "00", 384, base=server.base)
+    start = time.monotonic()
+    assert not cycle_watch.wait_for(url, max_wait_hours=0.5 / 3600, poll_seconds=0.1, max_poll_seconds=0.2)
+    elapsed = time.monotonic() - start
+    assert 0.5 <= elapsed < 1.0, elapsed  # the last sleep is cut to the deadline
+    assert len(server.log[server.path(url)]) >= 3
+
+
+if __name__ == "__main__":
+    for test in [test_latest_cycle, test_index_urls, test_available, test_poll_backoff, test_timeout]:
+        test()
+        print(f"{test.__name__}: ok")
@@ -0,0 +1,98 @@
+import os
+import time
+import shutil
+import logging
+import threading
+import contextlib
+import concurrent.futures
+from datetime import timedelta
+
+
+class RateLimiter:
+    """Request-rate and bandwidth budget shared by concurrent download jobs.
+
+    Both budgets are token buckets that may go into debt: acquire() reserves request tokens and the
+    bytes those requests are expected to pull, and sleeps until the reservation is paid off, so a
+    download waits for its share of the bandwidth before it starts instead of bursting past the cap.
+    consume() settles the difference once the actual size is known. Limits come from the arguments, else from the environment (see docker-compose.yml):
+        REQUESTS_PER_MINUTE  HTTP requests started per minute across all jobs (default 1200)
+        DOWNLOAD_MBPS        download bandwidth across all jobs in megabits per second (default 400)
+    """
+
+    def __init__(self, requests_per_minute=None, mbps=None):
+        self.rate = float(requests_per_minute or os.environ.get("REQUESTS_PER_MINUTE", 1200)) / 60
+        self.byte_rate = float(mbps or os.environ.get("DOWNLOAD_MBPS", 400)) * 1e6 / 8
+        self.capacity = max(1.0, self.rate * 10)  # allow a 10 s burst of requests
+        self.tokens = self.capacity
+        self.byte_tokens = self.byte_rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.byte_tokens = min(self.byte_rate, self.byte_tokens + elapsed * self.byte_rate)
+
+    def acquire(self, requests=1, nbytes=0):
+        """Reserve `requests` request tokens and `nbytes` expected bytes, blocking until the budget allows them."""
+        with self.lock:
+            self.refill()
+            self.tokens -= requests
+            self.byte_tokens -= nbytes
+            wait = max(0.0, -self.tokens / self.rate, -self.byte_tokens / self.byte_rate)
+        if wait:
+            time.sleep(wait)
+
+    def consume(self, nbytes):
+        """Charge bytes downloaded beyond what acquire() reserved (negative to refund an overestimate)."""
+        with self.lock:
+            self.refill()
+            self.byte_tokens = min(self.byte_rate, self.byte_tokens - nbytes)
+
+
+@contextlib.contextmanager
+def scratch_dir(root, name):
+    """Private working directory of one job, removed when the job ends (successful or not)."""
+    path = os.path.join(root, name)
+    shutil.rmtree(path, ignore_errors=True)  # leftovers of a killed earlier attempt
+    os.makedirs(path)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def run_backfill(items, job, workers=None, logger=None, desc="Backfill"):
+    """
+    Run job(item) for every item on a thread pool of `workers` jobs (env BACKFILL_JOBS, default 3).
+    Logs progress and an ETA from the observed throughput after each job, and yields
+    (item, result) in completion order; a job that raises yields (item, None). Falsy results count as failed.
+    """
+    workers = int(workers or os.environ.get("BACKFILL_JOBS", 3))
+    logger = logger or logging.getLogger(__name__)
+    items = list(items)
+    if not items:
+        return
+    logger.info(f"{desc}: {len(items)} job(s), {min(workers, len(items))} at a time")
+    start = time.monotonic()
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(job, item): item for item in items}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            item = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"{desc}: job {item} failed: {e}")
+                result = None
+            if not result:
+                failed += 1
+            elapsed = time.monotonic() - start
+            eta = elapsed / done * (len(items) - done)
+            logger.info(
+                f"{desc}: {done}/{len(items)} done ({failed} failed), "
+                f"elapsed {timedelta(seconds=round(elapsed))}, ETA {timedelta(seconds=round(eta))}"
+            )
+            yield item, result
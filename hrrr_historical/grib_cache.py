@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+
+class GribCache:
+    """Disk cache of GRIB subsets with a byte budget and LRU eviction.
+
+    Entries are keyed by (model, run, fxx, product, regex hash) and point at the subset files
+    Herbie writes under the cache folder. The index lives in cache_index.json next to them, so
+    hours fetched by one run (e.g. the daily job) are reused by the next (e.g. the month build).
+    The index is guarded by a lock so concurrent backfill jobs can share one cache.
+    """
+
+    def __init__(self, folder, max_gb, logger=None):
+        self.folder = folder
+        self.max_bytes = int(max_gb * 1024**3)
+        self.logger = logger or logging.getLogger(__name__)
+        self.index_path = os.path.join(folder, "cache_index.json")
+        self.lock = threading.RLock()
+        os.makedirs(folder, exist_ok=True)
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    @staticmethod
+    def key(model, run, fxx, product, regex):
+        """Cache key of one subset: model|run|fxx|product|regex hash."""
+        regex_hash = hashlib.blake2b(regex.encode(), digest_size=4).hexdigest()
+        run = run.strftime("%Y-%m-%dT%H") if hasattr(run, "strftime") else str(run)
+        return f"{model}|{run}|{int(fxx):02d}|{product}|{regex_hash}"
+
+    def save(self):
+        """Write the index atomically."""
+        with self.lock:
+            tmp = self.index_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.index, f)
+            os.replace(tmp, self.index_path)
+
+    def get(self, model, run, fxx, product, regex):
+        """Return the cached subset path and mark it used, or None on a miss."""
+        key = self.key(model, run, fxx, product, regex)
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            if not os.path.exists(entry["path"]) or os.path.getsize(entry["path"]) != entry["size"]:
+                del self.index[key]  # deleted or truncated behind our back
+                return None
+            entry["last_used"] = time.time()
+            return entry["path"]
+
+    def put(self, model, run, fxx, product, regex, path):
+        """Record a freshly downloaded subset."""
+        path = str(path)
+        if not os.path.exists(path):
+            return
+        with self.lock:
+            self.index[self.key(model, run, fxx, product, regex)] = {
+                "path": path,
+                "size": os.path.getsize(path),
+                "last_used": time.time(),
+            }
+
+    def size(self):
+        """Bytes held by the indexed subsets."""
+        with self.lock:
+            return sum(entry["size"] for entry in self.index.values())
+
+    def evict(self, keep=()):
+        """
+        Delete files in the cache folder that are not indexed (partial or stray downloads), then the
+        least recently used subsets until the cache fits the budget. Paths in `keep` are never deleted.
+        Unindexed files include downloads still in progress, so do not evict while jobs are downloading.
+        Returns the number of bytes freed.
+        """
+        keep = {str(p) for p in keep}
+        with self.lock:
+            indexed = {entry["path"] for entry in self.index.values()}
+            freed = 0
+            for root, _, files in os.walk(self.folder):
+                for name in files:
+                    path = os.path.join(root, name)
+                    if path == self.index_path or path in indexed or path in keep:
+                        continue
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+
+            total = self.size()
+            for key, entry in sorted(self.index.items(), key=lambda item: item[1]["last_used"]):
+                if total <= self.max_bytes:
+                    break
+                if entry["path"] in keep:
+                    continue
+                if os.path.exists(entry["path"]):
+                    os.remove(entry["path"])
+                del self.index[key]
+                total -= entry["size"]
+                freed += entry["size"]
+            self.save()
+            self.logger.info(f"GRIB cache: {total / 1024**3:.1f}GB of {self.max_bytes / 1024**3:.1f}GB used, freed {freed / 1024**3:.2f}GB")
+            return freed
@@ -3,8 +3,11 @@ from herbie import Herbie, FastHerbie
 import os
 import sys, warnings
 import numpy as np
-from hrrr_auto import HiddenPrints, get_multiple_HRRR, hrrr_process, NC2PWW
+from hrrr_auto import HiddenPrints, count_subset_requests, estimate_subset_bytes, get_multiple_HRRR, get_subset_paths, hrrr_process, NC2PWW, PWWWriter, PWW_START_OFFSET
 from helper import helper
+from grib_cache import GribCache
+from backfill import RateLimiter, run_backfill, scratch_dir
+from governor import ResourceGovernor
 from datetime import datetime, timedelta
 import pandas as pd
 from tqdm import tqdm
@@ -13,12 +16,16 @@ from typing import Callable
 import pickle
 import struct
 import multiprocessing as mp
+from multiprocessing import resource_tracker
 from glob import glob
 import re
 import logging
+import zipfile
+import threading
 from pydrive2.auth import GoogleAuth
 from pydrive2.drive import GoogleDrive
-import shutil
+from pydrive2.files import ApiRequestError, FileNotDownloadableError
+from httplib2 import HttpLib2Error
 
 warnings.filterwarnings("ignore", message="This pattern is interpreted as a regular expression, and has match groups.")
 warnings.filterwarnings("ignore", category=FutureWarning, message="In a future version of xarray the default value for compat will change")
@@ -32,6 +39,25 @@ DATA_DIR = os.path.join(BASE_DIR, "data")
 HISTORICAL_PWW_FOLDER = os.path.join(DATA_DIR, "historical_pww")
 HISTORICAL_ZIP_FOLDER = os.path.join(DATA_DIR, "historical_zip")
 GRIB_FOLDER = os.path.join(DATA_DIR, "grib")
+SCRATCH_FOLDER = os.path.join(DATA_DIR, "scratch")
+
+# Month mode streams hours through download -> decode -> encode -> PWW in windows of this size,
+# so peak disk and RAM are bounded by the window instead of the month
+MONTH_WINDOW_HOURS = int(os.environ.get("MONTH_WINDOW_HOURS", 24))
+
+# GRIB subsets are kept between runs up to this budget (least recently used evicted first),
+# so the month build and retries reuse hours the daily jobs already fetched
+GRIB_CACHE_GB = float(os.environ.get("GRIB_CACHE_GB", 25))
+
+# Missing days are backfilled BACKFILL_JOBS at a time (see backfill.py for the download budget).
+# Downloads overlap freely; only DECODE_JOBS jobs decode at once since each decode pool already
+# uses every core and a day's cube in shared memory
+BACKFILL_JOBS = int(os.environ.get("BACKFILL_JOBS", 3))
+DECODE_SLOTS = threading.BoundedSemaphore(int(os.environ.get("DECODE_JOBS", 1)))
+DRIVE_LOCK = threading.Lock()  # the pydrive2 client is not thread-safe
+# HTTP requests Herbie makes to locate one subset before its byte ranges: a HEAD for the GRIB,
+# a HEAD for its idx (both on the first source that has it) and a GET of the idx
+LOOKUP_REQUESTS = 3
 
 # PRODUCTION PRODUCTION PRODUCTION PRODUCTION PRODUCTION PRODUCTION PRODUCTION 
 DAILY_DRIVE_FOLDER_ID = "1Uc-tuSPEnh7rJzC3nFvxndFvULrsNe-U"
@@ -71,13 +97,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+grib_cache = GribCache(GRIB_FOLDER, GRIB_CACHE_GB, logger)
+rate_limiter = RateLimiter()
+
 # =========================
 # Utility Functions
 # =========================
 
 def ensure_directories():
     """Ensure necessary directories exist."""
-    for path in [HISTORICAL_PWW_FOLDER, HISTORICAL_ZIP_FOLDER, GRIB_FOLDER, 
+    for path in [HISTORICAL_PWW_FOLDER, HISTORICAL_ZIP_FOLDER, GRIB_FOLDER, SCRATCH_FOLDER,
                  os.path.join(BASE_DIR, "state_station")]:
         os.makedirs(path, exist_ok=True)
 
@@ -104,22 +133,53 @@ def get_drive_folder_id(mode):
         raise ValueError("Mode must be 'day', 'month', or 'archive'")
 
 def download_HRRR_fast(date_, fxx_):
-    """Download HRRR data using FastHerbie."""
+    """
+    Download the regex subsets of HRRR data using FastHerbie, skipping hours already in the GRIB cache.
+    Every HTTP request (LOOKUP_REQUESTS per subset, then one per byte range) is charged to the
+    shared rate_limiter budget, and the subset bytes before they are fetched.
+    Returns a dict mapping (run date, fxx) to the local subset files.
+    """
+    regex = r":(?:TMP|DPT|UGRD|VGRD|TCDC|DSWRF|COLMD|GUST|CPOFP|PRATE):((2|8|10|80) m above|entire atmosphere|surface|entire atmosphere single layer)"
+    paths = {}
+    missing = set()
+    for d in date_:
+        for f in fxx_:
+            path = grib_cache.get("hrrr", pd.Timestamp(d), f, "sfc", regex)
+            if path is None:
+                missing.add(pd.Timestamp(d))
+            else:
+                paths[(pd.Timestamp(d), f)] = path
+    logger.info(f"GRIB cache: {len(paths)} subsets cached, {len(missing)} run(s) to download")
+    if not missing:
+        grib_cache.save()
+        return paths
     try:
+        rate_limiter.acquire(len(missing) * len(fxx_) * LOOKUP_REQUESTS)
         H = FastHerbie(
-            date_,
+            sorted(missing),
             model="hrrr",
             product="sfc",
             fxx=fxx_,
             save_dir=GRIB_FOLDER,
         )
-        regex = r":(?:TMP|DPT|UGRD|VGRD|TCDC|DSWRF|COLMD|GUST|CPOFP|PRATE):((2|8|10|80) m above|entire atmosphere|surface|entire atmosphere single layer)"
+        expected = estimate_subset_bytes(H, regex)
+        rate_limiter.acquire(count_subset_requests(H, regex), expected)
         H.download(regex)
+        downloaded = 0
+        for (run, fxx), path in get_subset_paths(H, regex).items():
+            if os.path.exists(path):
+                grib_cache.put("hrrr", run, fxx, "sfc", regex, path)
+                paths[(run, fxx)] = path
+                downloaded += os.path.getsize(path)
+        rate_limiter.consume(downloaded - expected)
         del H
     except Exception as e:
         logger.error(f"Error in fetching data for {date_}: {e}")
+    grib_cache.save()
+    return paths
 
-def process_and_upload(target_date, fxx, product, regex, state, drive, hp, mode="day"):
+def process_and_upload(target_date, fxx, product, regex, state, drive, hp, mode="day", work_dir=None,
+                       governor=None, executor=None):
     """
     Process HRRR data and upload to Google Drive.
     Automatically routes to correct folder based on mode.
@@ -133,6 +193,8 @@ def process_and_upload(target_date, fxx, product, regex, state, drive, hp, mode=
         drive: Google Drive object
         hp: Helper object
         mode: "day" or "month" processing mode
+        work_dir: Folder for the PWW before it is zipped (a backfill job's scratch folder)
+        governor, executor: Decode pool shared by the backfill jobs (a new pool per call if None)
     """
     if isinstance(target_date, str):
         target_date = pd.to_datetime(target_date)
@@ -162,7 +224,7 @@ def process_and_upload(target_date, fxx, product, regex, state, drive, hp, mode=
     else:
         raise ValueError("Mode must be 'day' or 'month'")
     
-    pww_path = os.path.join(HISTORICAL_PWW_FOLDER, file_name)
+    pww_path = os.path.join(work_dir or HISTORICAL_PWW_FOLDER, file_name)
     zip_name = file_name.replace('.pww', '.zip')
     zip_path = os.path.join(HISTORICAL_ZIP_FOLDER, zip_name)
     
@@ -176,43 +238,57 @@ def process_and_upload(target_date, fxx, product, regex, state, drive, hp, mode=
             
             # Still check if needs upload to Google Drive
             if drive:
-                cloud_files = drive.ListFile({"q": f"'{folder_id}' in parents and trashed=false"}).GetList()
-                cloud_files_dict = {file["title"]: file for file in cloud_files}
-                
-                if zip_name not in cloud_files_dict:
-                    logger.info(f"Uploading existing {zip_name} to Google Drive {folder_name} folder...")
-                    hp.upload_to_drive(drive, folder_id, zip_path)
-                    logger.info(f"Successfully uploaded existing {zip_name}")
-                else:
-                    logger.info(f"{zip_name} already exists on Google Drive too. Skipping completely.")
+                with DRIVE_LOCK:
+                    cloud_files = drive.ListFile({"q": f"'{folder_id}' in parents and trashed=false"}).GetList()
+                    cloud_files_dict = {file["title"]: file for file in cloud_files}
+
+                    if zip_name not in cloud_files_dict:
+                        logger.info(f"Uploading existing {zip_name} to Google Drive {folder_name} folder...")
+                        hp.upload_to_drive(drive, folder_id, zip_path)
+                        logger.info(f"Successfully uploaded existing {zip_name}")
+                    else:
+                        logger.info(f"{zip_name} already exists on Google Drive too. Skipping completely.")
             
             return True
         
         # Check if already exists on Google Drive (but not locally)
         if drive:
-            cloud_files = drive.ListFile({"q": f"'{folder_id}' in parents and trashed=false"}).GetList()
+            with DRIVE_LOCK:
+                cloud_files = drive.ListFile({"q": f"'{folder_id}' in parents and trashed=false"}).GetList()
             cloud_files_dict = {file["title"]: file for file in cloud_files}
             
             if zip_name in cloud_files_dict:
                 logger.info(f"{zip_name} already exists in Google Drive {folder_name} folder. Skipping processing.")
                 return True
         
-        # Download GRIB data
-        logger.info(f"Downloading GRIB data for {description}...")
-        download_HRRR_fast(dates, fxx_=[fxx])
-        
-        # Process data
-        logger.info(f"Processing weather data...")
-        ds = get_multiple_HRRR(dates, fxx, product, regex, GRIB_FOLDER)
-        
-        if ds is not None:
-            # Apply HRRR processing
-            processed_ds = hrrr_process(ds)
-            
-            # Create PWW file
-            logger.info(f"Creating PWW file: {file_name}")
-            NC2PWW(processed_ds, pww_path, state)
+        if mode == "month":
+            # Concatenate the daily files; stream from GRIB only if they cannot be lined up
+            written = assemble_month(dates, fxx, product, regex, state, drive, hp, pww_path)
+            if written is None:
+                logger.info(f"Streaming {description} in {MONTH_WINDOW_HOURS}-hour windows into {file_name}...")
+                written = stream_to_pww(dates, fxx, product, regex, state, pww_path)
+        else:
+            # Download GRIB data
+            logger.info(f"Downloading GRIB data for {description}...")
+            paths = download_HRRR_fast(dates, fxx_=[fxx])
             
+            # Process data (one backfill job at a time per decode slot)
+            with DECODE_SLOTS:
+                logger.info(f"Processing weather data...")
+                ds = get_multiple_HRRR(dates, fxx, product, regex, GRIB_FOLDER, paths, governor=governor, executor=executor)
+                written = 0
+
+                if ds is not None:
+                    # Apply HRRR processing
+                    processed_ds = hrrr_process(ds)
+
+                    # Create PWW file
+                    logger.info(f"Creating PWW file: {file_name}")
+                    NC2PWW(processed_ds, pww_path, state)
+                    written = len(processed_ds.valid_time)
+                del ds
+        
+        if written:
             # Create zip file
             logger.info(f"Compressing to: {zip_name}")
             hp.zip_file(pww_path, zip_path, remove=True)  # Remove PWW after zipping
@@ -220,7 +296,8 @@ def process_and_upload(target_date, fxx, product, regex, state, drive, hp, mode=
             # Upload to Google Drive
             if drive:
                 logger.info(f"Uploading {zip_name} to Google Drive {folder_name} folder...")
-                hp.upload_to_drive(drive, folder_id, zip_path)
+                with DRIVE_LOCK:
+                    hp.upload_to_drive(drive, folder_id, zip_path)
                 logger.info(f"Successfully uploaded {zip_name}")
                 
                 # Optionally remove local zip file after upload
@@ -238,21 +315,157 @@ def process_and_upload(target_date, fxx, product, regex, state, drive, hp, mode=
         logger.error(f"Error processing {target_date}: {e}")
         return False
 
-def process_one_day(target_date, fxx, product, regex, state, drive=None, hp=None):
+def stream_to_pww(dates, fxx, product, regex, state, pww_path, window=None):
+    """
+    Download, decode, encode and append to the PWW in rolling windows of hours.
+    Hours already in the GRIB cache are not downloaded again, and the cache is trimmed
+    back to its budget after each window.
+    Returns the number of hours written.
+    """
+    window = window or MONTH_WINDOW_HOURS
+    with PWWWriter(pww_path, state) as writer:
+        for start in range(0, len(dates), window):
+            window_dates = dates[start:start + window]
+            logger.info(f"Window {start // window + 1}/{-(-len(dates) // window)}: "
+                        f"{window_dates[0]:%Y-%m-%d %H}h to {window_dates[-1]:%Y-%m-%d %H}h")
+            paths = download_HRRR_fast(window_dates, fxx_=[fxx])
+            try:
+                ds = get_multiple_HRRR(window_dates, fxx, product, regex, GRIB_FOLDER, paths)
+                if ds is not None:
+                    writer.append(hrrr_process(ds))
+                else:
+                    logger.warning(f"No data retrieved for window starting {window_dates[0]}")
+                del ds
+            finally:
+                # Keep disk bounded by the cache budget; this window's hours stay for later reuse
+                grib_cache.evict()
+        written = writer.count
+    if not written and os.path.exists(pww_path):
+        os.remove(pww_path)
+    return written
+
+def get_daily_zip(date, state, drive=None, folder=HISTORICAL_ZIP_FOLDER):
+    """
+    Return the local zip of one daily file, downloading it from the daily or archive Drive folder
+    into `folder` if it is not on disk. Returns None if the day was never built.
+    """
+    zip_name = f"{state}_{date.strftime('%Y_%m_%d')}.zip"
+    for zip_path in [os.path.join(HISTORICAL_ZIP_FOLDER, zip_name), os.path.join(folder, zip_name)]:
+        if os.path.exists(zip_path):
+            return zip_path
+    if drive:
+        with DRIVE_LOCK:
+            for folder_id in [DAILY_DRIVE_FOLDER_ID, ARCHIVE_DRIVE_FOLDER_ID]:
+                files = drive.ListFile({"q": f"'{folder_id}' in parents and title='{zip_name}' and trashed=false"}).GetList()
+                if files:
+                    logger.info(f"Downloading {zip_name} from Google Drive...")
+                    files[0].GetContentFile(zip_path)
+                    return zip_path
+    return None
+
+def assemble_month(dates, fxx, product, regex, state, drive, hp, pww_path):
+    """
+    Build a month PWW by concatenating the payloads of the daily PWW files, which hold the same hours.
+    Days with no daily file yet are built first (concurrently, see backfill_days); only their GRIBs
+    are downloaded. The month's first hour is the last hour of the previous day's file.
+    Returns the number of hours written, or None if a daily file is missing, short, unreadable or
+    does not line up with the others, or Drive fails (the month is then streamed from GRIB instead):
+    the PWW has no date table, so a month with a gap would give every later hour the wrong date.
+    Zips fetched from Drive are kept in a scratch folder and deleted once extracted.
+    """
+    if fxx != 1:
+        return None  # daily files only line up with month hours for fxx=1
+    month_start = dates[0] + pd.Timedelta(hours=fxx)
+    days = pd.date_range(month_start - pd.Timedelta(days=1), dates[-1].normalize(), freq="D")
+    first_hour = (np.datetime64(month_start, "ns").astype("int64") + 2209161600 * 10**9) / (10**9 * 86400)
+    with scratch_dir(SCRATCH_FOLDER, os.path.basename(pww_path)) as work_dir:
+        try:
+            missing = [day for day in days if get_daily_zip(day, state, drive, work_dir) is None]
+            if missing:
+                logger.info(f"Building {len(missing)} missing daily file(s) for the month...")
+                backfill_days(missing, fxx, product, regex, state, drive, hp)
+
+            logger.info(f"Assembling {os.path.basename(pww_path)} from {len(days)} daily files...")
+            with PWWWriter(pww_path, state) as writer:
+                for i, day in enumerate(days):
+                    zip_path = get_daily_zip(day, state, drive, work_dir)
+                    if zip_path is None:
+                        raise ValueError(f"no daily file for {day.strftime('%Y-%m-%d')}")
+                    with zipfile.ZipFile(zip_path) as z:
+                        day_pww = z.extract(z.namelist()[0], work_dir)
+                    if os.path.dirname(zip_path) == work_dir:
+                        os.remove(zip_path)  # downloaded from Drive for this month only
+                    try:
+                        if i == 0:
+                            # Only the previous day's last hour belongs to this month
+                            with open(day_pww, "rb") as f:
+                                f.seek(PWW_START_OFFSET + 8)
+                                end, = struct.unpack("<d", f.read(8))
+                            if abs(end - first_hour) * 24 > 1e-6:
+                                raise ValueError(f"previous day's file does not end at {month_start}")
+                            writer.append_pww(day_pww, last_hour=True, hours=24)
+                        else:
+                            writer.append_pww(day_pww, hours=24)
+                    finally:
+                        os.remove(day_pww)
+                written = writer.count
+            if written != len(dates):
+                raise ValueError(f"{written} hours assembled, the month has {len(dates)}")
+        except (ValueError, OSError, zipfile.BadZipFile, ApiRequestError, FileNotDownloadableError, HttpLib2Error) as e:
+            logger.warning(f"Cannot assemble the month from daily files: {e}")
+            if os.path.exists(pww_path):
+                os.remove(pww_path)
+            return None
+    if not written and os.path.exists(pww_path):
+        os.remove(pww_path)
+    return written
+
+def process_one_day(target_date, fxx, product, regex, state, drive=None, hp=None, work_dir=None, governor=None, executor=None):
     """Process exactly one day (24 hours) - uploads to daily folder"""
-    return process_and_upload(target_date, fxx, product, regex, state, drive, hp, mode="day")
+    return process_and_upload(target_date, fxx, product, regex, state, drive, hp, mode="day", work_dir=work_dir,
+                              governor=governor, executor=executor)
 
 def process_one_month(target_month, fxx, product, regex, state, drive=None, hp=None):
     """Process exactly one month (all hours in that month) - uploads to monthly folder"""
     return process_and_upload(target_month, fxx, product, regex, state, drive, hp, mode="month")
 
+def backfill_days(dates, fxx, product, regex, state, drive=None, hp=None):
+    """
+    Process several days concurrently (BACKFILL_JOBS at a time), each in its own scratch folder,
+    under the shared download budget. The jobs decode on one process pool, forked before the job
+    threads start. The GRIB cache is trimmed once all jobs are done.
+    Returns (successful, failed).
+    """
+    governor = ResourceGovernor(logger=logger)
+
+    successful = 0
+    failed = 0
+    try:
+        # Workers attach to the decode cubes in shared memory: they must share this process's tracker
+        resource_tracker.ensure_running()
+        with governor.executor() as executor:
+            executor.submit(int).result()  # start the (forked) workers before the job threads exist
+
+            def job(date):
+                date = pd.to_datetime(date)
+                with scratch_dir(SCRATCH_FOLDER, date.strftime("%Y_%m_%d")) as work_dir:
+                    return process_one_day(date, fxx, product, regex, state, drive, hp, work_dir=work_dir,
+                                           governor=governor, executor=executor)
+
+            for _, success in run_backfill(dates, job, BACKFILL_JOBS, logger, desc="Daily backfill"):
+                if success:
+                    successful += 1
+                else:
+                    failed += 1
+    finally:
+        # Evicting sweeps unindexed files, which would include other jobs' downloads in progress
+        cleanup_grib()
+    return successful, failed
+
 def cleanup_grib():
-    """Clean up GRIB files after processing."""
+    """Trim the GRIB cache back to its byte budget (least recently used subsets first)."""
     try:
-        if os.path.exists(GRIB_FOLDER):
-            shutil.rmtree(GRIB_FOLDER)
-            os.makedirs(GRIB_FOLDER, exist_ok=True)
-            logger.info("GRIB files cleaned up.")
+        grib_cache.evict()
     except Exception as e:
         logger.warning(f"Failed to clean up GRIB files: {e}")
 
@@ -284,7 +497,12 @@ def process_date_range_with_cleanup(start_date, end_date, fxx, product, regex, s
     
     logger.info(f"Processing {len(date_range)} {mode}(s) from {start_date.date()} to {end_date.date()}")
     logger.info(f"Files will be uploaded to Google Drive {folder_name} folder")
-    
+
+    if mode == "day":
+        successful, failed = backfill_days(date_range, fxx, product, regex, state, drive, hp)
+        logger.info(f"Summary: {successful} successful, {failed} failed")
+        return successful, failed
+
     for i, date in enumerate(date_range, 1):
         logger.info(f"Processing {mode} {i}/{len(date_range)}: {date.strftime('%Y-%m-%d')}")
         
@@ -450,23 +668,11 @@ def main():
     
     cleanup_grib()
     
-    # FOURTH: Process missing daily files from the past 30 days
+    # FOURTH: Backfill missing daily files from the past 30 days, several days at a time
+    missing_daily_dates = [d for d in missing_daily_dates if d.date() != yesterday.date()]
     if missing_daily_dates:
         logger.info(f"Processing {len(missing_daily_dates)} missing daily files...")
-        successful = 0
-        failed = 0
-        
-        for i, missing_date in enumerate(missing_daily_dates, 1):
-            logger.info(f"Processing missing daily file {i}/{len(missing_daily_dates)}: {missing_date.strftime('%Y-%m-%d')}")
-            
-            success = process_one_day(missing_date, fxx, product, regex, state, drive, hp)
-            if success:
-                successful += 1
-            else:
-                failed += 1
-            
-            cleanup_grib()
-        
+        successful, failed = backfill_days(missing_daily_dates, fxx, product, regex, state, drive, hp)
         logger.info(f"Missing daily files summary: {successful} successful, {failed} failed")
     
     # FIFTH: Process missing monthly files from the past 6 months
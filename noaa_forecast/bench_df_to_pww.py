@@ -0,0 +1,87 @@
+# Times df_to_pww against the per-value writer it replaced and checks that both write the same bytes.
+# Runs on synthetic decoded steps at the station locations (no GRIB or network needed):
+#   python bench_df_to_pww.py [steps ...]      (default: 6 48)
+import os
+import sys
+import time
+import struct
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import weather_api
+from gfs_variables import PWW_VARIABLES, required_fields
+
+
+def synthetic_steps(steps, seed=0):
+    """Long frame of `steps` hourly steps as read_wrapper saves them, one row per station."""
+    _, lat, lon = weather_api.read_stations()
+    rng = np.random.default_rng(seed)
+    n = len(lat)
+    ranges = {"t2m": (240, 310), "d2m": (230, 300), "u10": (-15, 15), "v10": (-15, 15),
+              "u100": (-25, 25), "v100": (-25, 25), "tcc": (0, 100)}
+    frames = []
+    for step in range(steps):
+        df = pd.DataFrame({"latitude": lat, "longitude": lon + 360})
+        for field in required_fields():
+            df[field] = rng.uniform(*ranges[field], n)
+        df["valid_time"] = pd.Timestamp("2025-01-01") + pd.Timedelta(hours=step)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def loop_df_to_pww(df, file_name):
+    """The writer df_to_pww replaced: one date filter and one int.to_bytes per value (df already aggregated)."""
+    df_station = pd.read_parquet("station.parquet")
+    df.sort_values(by=["UTCISO8601", "WhoAmI"], inplace=True)
+    unique_dates = df["UTCISO8601"].unique()
+    with open(file_name, "wb") as file:
+        file.write(struct.pack("<hhh", 2001, 8065, 1))
+        file.write(struct.pack("<dd", df["UTCISO8601"].min(), df["UTCISO8601"].max()))
+        file.write(struct.pack("<dddd", int(df_station["Latitude"].min()), int(df_station["Latitude"].max()),
+                               int(df_station["Longitude"].min()), int(df_station["Longitude"].max())))
+        file.write(struct.pack("<h", 0))
+        file.write(struct.pack("<iiihh", len(unique_dates), 0, df_station["WhoAmI"].nunique(), 0, len(PWW_VARIABLES)))
+        for code in PWW_VARIABLES:
+            file.write(struct.pack("<h", code))
+        file.write(struct.pack("<h", 8))
+        for date in unique_dates:
+            file.write(struct.pack("<d", date))
+        file.write(open("NOAA_station.pkl", "rb").read())
+        for date in unique_dates:
+            rows = df[df["UTCISO8601"] == date]
+            for column in weather_api.PWW_COLUMNS:
+                for value in rows[column]:
+                    file.write(value.to_bytes(1, "little"))
+
+
+def bench(steps):
+    raw = synthetic_steps(steps)
+    start = time.perf_counter()
+    df = weather_api.aggregate(raw)
+    aggregate_seconds = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as folder:
+        os.makedirs(f"{folder}/pww")
+        data, aggregate = weather_api.Data, weather_api.aggregate
+        weather_api.Data, weather_api.aggregate = folder, lambda frame: frame  # time the writers only
+        try:
+            start = time.perf_counter()
+            loop_df_to_pww(df.copy(), f"{folder}/loop.pww")
+            loop_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            new = weather_api.df_to_pww(df.copy(), "2025-01-01", "00")
+            new_seconds = time.perf_counter() - start
+        finally:
+            weather_api.Data, weather_api.aggregate = data, aggregate
+        same = open(f"{folder}/loop.pww", "rb").read() == open(new, "rb").read()
+    print(f"{steps} steps ({len(raw)} rows): aggregate {aggregate_seconds:.2f}s, "
+          f"df_to_pww {loop_seconds:.2f}s -> {new_seconds:.2f}s ({loop_seconds / new_seconds:.0f}x), identical: {same}")
+    return same
+
+
+if __name__ == "__main__":
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    results = [bench(int(steps)) for steps in sys.argv[1:] or [6, 48]]
+    sys.exit(0 if all(results) else 1)
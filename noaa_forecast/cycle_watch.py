@@ -0,0 +1,69 @@
+import os
+import time
+import random
+import logging
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta, timezone
+
+# Index listings polled for a cycle's last step; point them at a local server to test the watcher
+GFS_IDX_BASE = os.environ.get("GFS_IDX_BASE", "https://nomads.ncep.noaa.gov/pub/data/nccf/com/gfs/prod")
+HRRR_IDX_BASE = os.environ.get("HRRR_IDX_BASE", "https://noaa-hrrr-bdp-pds.s3.amazonaws.com")
+
+POLL_SECONDS = float(os.environ.get("CYCLE_POLL_SECONDS", 30))  # first wait between checks, doubled per check
+MAX_POLL_SECONDS = float(os.environ.get("CYCLE_MAX_POLL_SECONDS", 120))  # longest wait between checks
+MAX_WAIT_HOURS = float(os.environ.get("CYCLE_MAX_WAIT_HOURS", 3))  # give up on a cycle after this long
+
+
+def gfs_idx_url(date, t, step, base=GFS_IDX_BASE):
+    """Index of one GFS 0.25 degree step (date YYYYMMDD, t HH)."""
+    return f"{base}/gfs.{date}/{t}/atmos/gfs.t{t}z.pgrb2.0p25.f{step:03d}.idx"
+
+
+def hrrr_idx_url(run, fxx, product="sfc", base=HRRR_IDX_BASE):
+    """Index of one CONUS HRRR forecast hour of the run at datetime `run`."""
+    return f"{base}/hrrr.{run:%Y%m%d}/conus/hrrr.t{run:%H}z.wrf{product}f{fxx:02d}.grib2.idx"
+
+
+def latest_cycle(every_hours, ready_after, now=None):
+    """
+    Most recent cycle (UTC datetime, every `every_hours` hours from 00Z) that started at least
+    `ready_after` (timedelta) before now, i.e. the cycle whose last step is expected next.
+    """
+    now = now or datetime.now(timezone.utc)
+    start = now - ready_after
+    return start.replace(hour=start.hour // every_hours * every_hours, minute=0, second=0, microsecond=0)
+
+
+def available(url, timeout=30):
+    """True if `url` exists (HEAD answers 2xx); missing files and network errors are False."""
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method="HEAD"), timeout=timeout) as response:
+            return 200 <= response.status < 300
+    except (urllib.error.URLError, OSError):
+        return False
+
+
+def wait_for(url, max_wait_hours=MAX_WAIT_HOURS, poll_seconds=POLL_SECONDS, max_poll_seconds=MAX_POLL_SECONDS, logger=None):
+    """
+    Poll `url` until it exists, waiting poll_seconds after the first miss and doubling (with
+    jitter) up to max_poll_seconds. Returns True as soon as it exists, False after max_wait_hours.
+    """
+    logger = logger or logging.getLogger(__name__)
+    deadline = time.monotonic() + max_wait_hours * 3600
+    delay = poll_seconds
+    checks = 0
+    while True:
+        checks += 1
+        if available(url):
+            if checks > 1:
+                logger.info(f"{url} available after {checks} checks")
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logger.warning(f"{url} still missing after {max_wait_hours}h, giving up")
+            return False
+        if checks == 1:
+            logger.info(f"Waiting for {url}")
+        time.sleep(min(remaining, delay * random.uniform(0.8, 1.2)))
+        delay = min(max_poll_seconds, delay * 2)
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import hashlib
+import random
+import asyncio
+import logging
+
+import aiohttp
+from tqdm import tqdm
+
+from gfs_variables import filter_query
+
+logger = logging.getLogger("weather_api")
+
+# NOMADS allows 50 hits per minute per client; keep the burst inside that window
+HITS_PER_MINUTE = int(os.environ.get("NOMADS_HITS_PER_MINUTE", 50))
+BURST = 2
+CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", 4))  # requests in flight at once
+RETRIES = int(os.environ.get("DOWNLOAD_RETRIES", 8))  # attempts per step before it is given up
+RETRY_DELAY = 10  # seconds before the first retry, doubled per attempt up to MAX_RETRY_DELAY
+MAX_RETRY_DELAY = 300
+TIMEOUT = aiohttp.ClientTimeout(total=300, sock_read=60)
+
+# hourly steps for 5 days, then every 3 hours up to 16 days (209 steps)
+GFS_STEPS = list(range(0, 120)) + list(range(120, 385, 3))
+
+FILTER_URL = "https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25_1hr.pl"
+FILTER_QUERY = filter_query()  # only the fields the PWW variables need (see gfs_variables.py)
+
+
+def gfs_url(date, t, step, base_url=FILTER_URL):
+    """NOMADS grib filter URL of one GFS 0.25 degree forecast step."""
+    return f"{base_url}?dir=%2Fgfs.{date}%2F{t}%2Fatmos&file=gfs.t{t}z.pgrb2.0p25.f{step:03d}" + FILTER_QUERY
+
+
+class CycleManifest:
+    """Record of the steps of one cycle already on disk: file name, size and sha256 per step.
+
+    Kept as manifest.json in the cycle's raw folder and saved after every step, so a restarted
+    run only downloads steps that are missing or whose file no longer matches its entry.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, "manifest.json")
+        try:
+            with open(self.path) as f:
+                self.steps = json.load(f)
+        except (OSError, ValueError):
+            self.steps = {}
+
+    def save(self):
+        """Write the manifest atomically."""
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.steps, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def add(self, step, name, size, sha256):
+        """Record a downloaded step."""
+        self.steps[f"{step:03d}"] = {"file": name, "size": size, "sha256": sha256}
+        self.save()
+
+    def verify(self):
+        """Drop entries whose file is gone, truncated or changed. Returns the number dropped."""
+        dropped = 0
+        for key, entry in list(self.steps.items()):
+            path = os.path.join(self.folder, entry["file"])
+            if not os.path.exists(path) or os.path.getsize(path) != entry["size"] or file_sha256(path) != entry["sha256"]:
+                del self.steps[key]
+                dropped += 1
+        if dropped:
+            self.save()
+        return dropped
+
+    def complete(self, step):
+        """True if the step is recorded (call verify() first to trust the files)."""
+        return f"{step:03d}" in self.steps
+
+    def files(self, steps=None):
+        """Paths of the recorded steps in step order."""
+        keys = sorted(self.steps) if steps is None else [f"{step:03d}" for step in steps if self.complete(step)]
+        return [os.path.join(self.folder, self.steps[key]["file"]) for key in keys]
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class TokenBucket:
+    """Asyncio token bucket: never more than `per_minute` requests start in any 60 s window."""
+
+    def __init__(self, per_minute=HITS_PER_MINUTE, burst=BURST):
+        self.rate = (per_minute - burst) / 60
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait for a token; callers are served in arrival order."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def fetch_step(session, bucket, slots, url, path, retries=RETRIES):
+    """
+    Download one step to `path` (via a .part file), retrying with jittered exponential backoff.
+    A retry only waits for its own step; the slot is released while it sleeps.
+    Returns (size, sha256) of the file, or None if every attempt failed.
+    """
+    for attempt in range(retries):
+        try:
+            sha256 = hashlib.sha256()
+            size = 0
+            async with slots:
+                # Take the token only once a slot is free: tokens taken while queued would be spent in a burst
+                await bucket.acquire()
+                async with session.get(url) as response:
+                    response.raise_for_status()
+                    with open(path + ".part", "wb") as out_file:
+                        async for chunk in response.content.iter_chunked(1 << 20):
+                            out_file.write(chunk)
+                            sha256.update(chunk)
+                            size += len(chunk)
+            os.replace(path + ".part", path)
+            return size, sha256.hexdigest()
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            delay = min(MAX_RETRY_DELAY, RETRY_DELAY * 2**attempt) * random.uniform(0.5, 1.5)
+            logger.warning(f"Error downloading {os.path.basename(path)} (attempt {attempt + 1}/{retries}): {e!r}, retrying in {delay:.0f}s")
+            await asyncio.sleep(delay)
+    logger.error(f"Failed to download {os.path.basename(path)} after {retries} attempts")
+    if os.path.exists(path + ".part"):
+        os.remove(path + ".part")
+    return None
+
+
+async def download_cycle(date, t, folder, steps=GFS_STEPS, base_url=FILTER_URL, per_minute=HITS_PER_MINUTE,
+                         concurrency=CONCURRENCY, retries=RETRIES, on_step=None):
+    """
+    Download every step of a GFS cycle into `folder` as {date}{t}_{step:03d}, keeping `concurrency`
+    requests in flight over keep-alive connections and starting at most `per_minute` per minute.
+    Steps already in the folder's manifest (and matching it) are not downloaded again.
+    on_step(step, path) is called for every complete step, present or new, as soon as it is on disk;
+    it runs on the event loop and must not block (e.g. put the step in a queue).
+    Returns the CycleManifest of the folder.
+    """
+    manifest = CycleManifest(folder)
+    dropped = manifest.verify()
+    present = [step for step in steps if manifest.complete(step)]
+    if present or dropped:
+        logger.info(f"Manifest: {len(present)} steps already downloaded, {dropped} missing or corrupt")
+    if on_step is not None:
+        for step in present:
+            on_step(step, manifest.files([step])[0])
+    steps = [step for step in steps if not manifest.complete(step)]
+    if not steps:
+        return manifest
+
+    bucket = TokenBucket(per_minute)
+    slots = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=60)
+    progress_bar = tqdm(total=len(steps), desc="Downloading weather data", unit="file")
+
+    async def fetch(step):
+        name = f"{date}{t}_{step:03d}"
+        result = await fetch_step(session, bucket, slots, gfs_url(date, t, step, base_url), os.path.join(folder, name), retries)
+        if result is not None:
+            manifest.add(step, name, *result)
+            if on_step is not None:
+                on_step(step, os.path.join(folder, name))
+        progress_bar.update(1)
+
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=TIMEOUT) as session:
+            await asyncio.gather(*[fetch(step) for step in steps])
+    finally:
+        progress_bar.close()
+    return manifest
+
+
+def download_gfs(date, t, folder, **kwargs):
+    """Blocking wrapper of download_cycle."""
+    return asyncio.run(download_cycle(date, t, folder, **kwargs))
@@ -0,0 +1,122 @@
+# =========================
+# GFS variable registry
+# =========================
+# The GRIB fields read from each GFS step and the PWW variables built from them. The NOMADS
+# filter query and the readers are generated from these tables, so a field is only downloaded
+# if a PWW variable needs it.
+
+import numpy as np
+
+# cfgrib name -> NOMADS filter var and level, and the GRIB2
+# (parameterCategory, parameterNumber, typeOfFirstFixedSurface, level, stepType) of its message.
+# Messages are matched on the numbers because the eccodes shortName of a field depends on the
+# centre's local tables (100 m wind is "100u" or "u" depending on the eccodes version).
+GRIB_FIELDS = {
+    "t2m": {"var": "TMP", "lev": "2_m_above_ground", "grib": (0, 0, 103, 2, "instant")},
+    "d2m": {"var": "DPT", "lev": "2_m_above_ground", "grib": (0, 6, 103, 2, "instant")},
+    "u10": {"var": "UGRD", "lev": "10_m_above_ground", "grib": (2, 2, 103, 10, "instant")},
+    "v10": {"var": "VGRD", "lev": "10_m_above_ground", "grib": (2, 3, 103, 10, "instant")},
+    "u100": {"var": "UGRD", "lev": "100_m_above_ground", "grib": (2, 2, 103, 100, "instant")},
+    "v100": {"var": "VGRD", "lev": "100_m_above_ground", "grib": (2, 3, 103, 100, "instant")},
+    "tcc": {"var": "TCDC", "lev": "entire_atmosphere", "grib": (6, 1, 10, 0, "instant")},
+}
+
+# PWW variable code -> GRIB fields it is computed from, in the order the PWW file stores them
+PWW_VARIABLES = {
+    102: ("t2m",),  # Temp in F
+    104: ("d2m",),  # Dew point in F
+    106: ("u10", "v10"),  # Wind speed at surface (10m) in mph
+    107: ("u10", "v10"),  # Wind direction at surface (10m) in 5-degree increments
+    119: ("tcc",),  # Total cloud cover percentage
+    110: ("u100", "v100"),  # Wind speed at 100m in mph
+    120: (),  # Global Horizontal Irradiance in W/m^2 divided by 5 (not in GFS, written as 255)
+    121: (),  # Direct Horizontal Irradiance in W/m^2 divided by 5 (not in GFS, written as 255)
+}
+
+# area=[58, -130, 24, -60] North 58°, West -130°, South 24°, East -60°
+REGION = {"toplat": 58, "leftlon": 230, "rightlon": 300, "bottomlat": 24}
+
+
+def required_fields(codes=PWW_VARIABLES):
+    """GRIB fields needed for the given PWW codes, in GRIB_FIELDS order."""
+    needed = {field for code in codes for field in PWW_VARIABLES[code]}
+    return [field for field in GRIB_FIELDS if field in needed]
+
+
+def filter_query(fields=None, region=REGION):
+    """
+    NOMADS grib filter query for `fields` (default: every field a PWW variable needs).
+    The filter returns each requested var at each requested level, so fields sharing a level
+    cost nothing extra; the few cross-product extras (e.g. TMP at 10 m) are ignored by the readers.
+    """
+    fields = required_fields() if fields is None else fields
+    variables = dict.fromkeys(GRIB_FIELDS[field]["var"] for field in fields)
+    levels = dict.fromkeys(GRIB_FIELDS[field]["lev"] for field in fields)
+    query = "".join(f"&var_{var}=on" for var in sorted(variables))
+    query += "".join(f"&lev_{lev}=on" for lev in levels)
+    query += "&subregion=" + "".join(f"&{key}={value}" for key, value in region.items())
+    return query
+
+
+def grib_lookup(fields=None):
+    """{GRIB2 key tuple (see GRIB_FIELDS): slot of the field in `fields`} for the eccodes reader."""
+    fields = required_fields() if fields is None else fields
+    return {GRIB_FIELDS[field]["grib"]: i for i, field in enumerate(fields)}
+
+
+# =========================
+# PWW encoders
+# =========================
+# Each encoder maps the float32 fields of one step to the uint8 codes of one PWW variable with the
+# same float32 operations aggregate() applies to the long frame. Values outside 0..254 (which
+# aggregate's integer casts cannot write) and missing points become 255.
+
+def pww_code(v):
+    """Values outside 0..254 and NaN become 255, then cast to uint8."""
+    with np.errstate(invalid="ignore"):
+        return np.where((v >= 0) & (v < 255), v, 255).astype(np.uint8)
+
+def encode_temperature(k):
+    """Kelvin to degF, offset by 115 (codes 102 and 104)."""
+    return pww_code(np.round((k - 273.15) * 9 / 5 + 32) + 115)
+
+def encode_speed(u, v):
+    """Wind speed in mph from the u/v components (m/s)."""
+    return pww_code(np.round(np.sqrt(u ** 2 + v ** 2) * 2.23694))
+
+def encode_direction(u, v):
+    """Wind direction in 5 degree steps (the fifths are truncated) from the u/v components."""
+    return pww_code(np.trunc(np.round(np.arctan2(u, v) * 180 / np.pi + 180) / 5))
+
+def encode_cloud(tcc):
+    """Total cloud cover percentage, truncated."""
+    return pww_code(np.trunc(tcc))
+
+def encode_speed_truncated(u, v):
+    """Wind speed in mph from the u/v components, truncated instead of rounded (100 m wind)."""
+    return pww_code(np.trunc(np.sqrt(u ** 2 + v ** 2) * 2.23694))
+
+PWW_ENCODERS = {
+    102: encode_temperature,
+    104: encode_temperature,
+    106: encode_speed,
+    107: encode_direction,
+    119: encode_cloud,
+    110: encode_speed_truncated,
+    120: None,  # not in GFS
+    121: None,
+}
+
+def encode_step(values, fields=None, out=None):
+    """
+    Encode one step's (var, lat, lon) float32 fields, in `fields` order, to the (code, lat, lon)
+    uint8 codes of every PWW variable in PWW_VARIABLES order. Writes into `out` if given.
+    """
+    fields = required_fields() if fields is None else fields
+    field = dict(zip(fields, values))
+    if out is None:
+        out = np.empty((len(PWW_VARIABLES),) + values.shape[1:], dtype=np.uint8)
+    for i, (code, inputs) in enumerate(PWW_VARIABLES.items()):
+        encoder = PWW_ENCODERS[code]
+        out[i] = 255 if encoder is None else encoder(*(field[name] for name in inputs))
+    return out
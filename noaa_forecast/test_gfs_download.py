@@ -0,0 +1,130 @@
+# Checks gfs_download against a local stand-in for the NOMADS filter (no network needed):
+#   python test_gfs_download.py      or      python -m pytest test_gfs_download.py
+import os
+import time
+import socket
+import asyncio
+import hashlib
+import tempfile
+import threading
+
+from aiohttp import web
+
+import gfs_download
+
+STEPS = list(range(30))
+
+
+class StandIn:
+    """aiohttp server in a thread answering gfs_url requests with a small body per step.
+
+    Records the start time of every request and the most requests in flight at once. The first
+    `slow` requests take `slow_seconds`; steps in `flaky` answer 503 to their first flaky[step] requests.
+    """
+
+    def __init__(self, slow=0, slow_seconds=0, flaky=None, delay=0.02):
+        self.slow, self.slow_seconds, self.delay = slow, slow_seconds, delay
+        self.flaky = dict(flaky or {})
+        self.starts, self.hits, self.log = [], {}, []
+        self.in_flight = self.max_in_flight = 0
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        self.url = f"http://127.0.0.1:{self.port}/filter"
+        threading.Thread(target=asyncio.run, args=(self.serve(),), daemon=True).start()
+        time.sleep(0.3)
+
+    @staticmethod
+    def body(step):
+        return f"GRIB step {step:03d} ".encode() * 1000
+
+    async def handle(self, request):
+        step = int(request.query["file"][-3:])
+        self.starts.append(time.monotonic())
+        self.log.append((self.starts[-1], step))
+        self.hits[step] = self.hits.get(step, 0) + 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.slow_seconds if len(self.starts) <= self.slow else self.delay)
+            if self.hits[step] <= self.flaky.get(step, 0):
+                return web.Response(status=503)
+            return web.Response(body=self.body(step))
+        finally:
+            self.in_flight -= 1
+
+    async def serve(self):
+        app = web.Application()
+        app.router.add_get("/filter", self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", self.port).start()
+        await asyncio.Event().wait()
+
+
+def most_in_window(starts, window):
+    """Most request starts inside any `window` seconds."""
+    starts = sorted(starts)
+    return max(sum(1 for t in starts[i:] if t < start + window) for i, start in enumerate(starts))
+
+
+def test_concurrency_and_rate_cap():
+    # A server that stalls the first requests: queued steps must not bank tokens and burst afterwards
+    server = StandIn(slow=2, slow_seconds=2)
+    per_minute, concurrency = 600, 2
+    with tempfile.TemporaryDirectory() as folder:
+        manifest = gfs_download.download_gfs("20250101", "00", folder, steps=STEPS, base_url=server.url,
+                                             per_minute=per_minute, concurrency=concurrency)
+        assert len(manifest.files()) == len(STEPS)
+    assert server.max_in_flight <= concurrency
+    window = 1.0
+    allowed = gfs_download.BURST + (per_minute - gfs_download.BURST) / 60 * window + 1  # +1 for timer jitter
+    assert most_in_window(server.starts, window) <= allowed, most_in_window(server.starts, window)
+
+
+def test_retry_backoff():
+    server = StandIn(flaky={3: 2, 7: 99})
+    delay, gfs_download.RETRY_DELAY = gfs_download.RETRY_DELAY, 0.2
+    try:
+        retry_backoff(server)
+    finally:
+        gfs_download.RETRY_DELAY = delay
+
+
+def retry_backoff(server):
+    with tempfile.TemporaryDirectory() as folder:
+        manifest = gfs_download.download_gfs("20250101", "00", folder, steps=STEPS[:10], base_url=server.url,
+                                             per_minute=6000, concurrency=4, retries=3)
+        assert server.hits[3] == 3 and manifest.complete(3)  # two 503s, then the file
+        assert server.hits[7] == 3 and not manifest.complete(7)  # given up after `retries` attempts
+        assert not os.path.exists(os.path.join(folder, "2025010100_007.part"))
+        assert sorted(int(key) for key in manifest.steps) == [s for s in STEPS[:10] if s != 7]
+    # Jittered doubling: the attempts of step 3 are at least 0.5 * 0.2 s and 0.5 * 0.4 s apart
+    attempts = [t for t, step in server.log if step == 3]
+    assert attempts[1] - attempts[0] >= 0.1 and attempts[2] - attempts[1] >= 0.2
+
+
+def test_manifest_resume():
+    server = StandIn()
+    with tempfile.TemporaryDirectory() as folder:
+        kwargs = dict(steps=STEPS[:10], base_url=server.url, per_minute=6000, concurrency=4)
+        manifest = gfs_download.download_gfs("20250101", "00", folder, **kwargs)
+        for step in STEPS[:10]:
+            entry = manifest.steps[f"{step:03d}"]
+            assert entry["sha256"] == hashlib.sha256(StandIn.body(step)).hexdigest()
+        # One file corrupted, one deleted: only those two are fetched again
+        with open(os.path.join(folder, "2025010100_002"), "r+b") as f:
+            f.write(b"X")
+        os.remove(os.path.join(folder, "2025010100_005"))
+        server.hits.clear()
+        seen = []
+        manifest = gfs_download.download_gfs("20250101", "00", folder, on_step=lambda step, path: seen.append(step), **kwargs)
+        assert sorted(server.hits) == [2, 5]
+        assert sorted(seen) == STEPS[:10]  # present steps are reported too
+        assert manifest.verify() == 0
+
+
+if __name__ == "__main__":
+    for test in [test_concurrency_and_rate_cap, test_retry_backoff, test_manifest_resume]:
+        test()
+        print(f"{test.__name__}: ok")
@@ -1,6 +1,5 @@
 # https://claude.ai/chat/033f9dff-1e16-4ee4-86f4-5af52a824c53
 
-import urllib.request
 import time
 import shutil
 from datetime import datetime, timedelta
@@ -9,13 +8,18 @@ import pandas as pd
 import numpy as np
 import zipfile
 
-from multiprocessing import Process, Queue, Pool
+from multiprocessing import Process, Queue
 import multiprocessing as mp
-import os, sys, glob ,re
+import os, sys ,re
 import struct
 import pytz
 import pickle
 import psutil
+import eccodes
+import queue
+import threading
+import concurrent.futures
+import fastparquet
 
 import logging
 import logging.config
@@ -64,9 +68,27 @@ parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.insert(0, parent_dir)
 
 from helper import helper
+from governor import ResourceGovernor, run_measured
+from gfs_download import download_gfs, GFS_STEPS
+from cycle_watch import latest_cycle, wait_for, gfs_idx_url
+from gfs_variables import PWW_VARIABLES, required_fields, grib_lookup, encode_step, pww_code
 # print(sys.path)
 # print(os.getcwd())
 
+# Intermediate parquet of the decoded steps (see ParquetSink):
+#   off    no parquet, only the PWW
+#   sync   one parquet per step, written by the decode worker (default)
+#   async  one zstd parquet per cycle, written by a background thread in row groups of PARQUET_BATCH steps
+PARQUET_SINK = os.environ.get("PARQUET_SINK", "sync").lower()
+PARQUET_BATCH = int(os.environ.get("PARQUET_BATCH", 24))
+# Decode each step as soon as it is downloaded (stream_cycle) instead of after the whole cycle
+STREAM_DECODE = os.environ.get("STREAM_DECODE", "true").lower() in ("1", "true", "yes")
+# Interpolate the 3-hourly tail of the cycle (after f120) to hourly steps and write a fixed-interval PWW
+HOURLY_PWW = os.environ.get("HOURLY_PWW", "false").lower() in ("1", "true", "yes")
+HOURLY_CHUNK = 24  # interpolated hours encoded per block, to bound the float32 temporaries
+# A GFS cycle's f384 is usually listed 3.5 to 5 hours after the cycle time
+GFS_READY_AFTER = timedelta(hours=3, minutes=30)
+
 # set the logging configuration for the script
 DEBUG = False
 log_file = f"{Data}/download.log"
@@ -180,249 +202,315 @@ def aggregate(df):
     return df
 
 
-def read(path, date, t, shared_queue):
-    logger.debug(f"Reading {path}")
-    dfs = []
-    # * Copy and paste the folder path where you downloaded the data
-    keys = ["t2m", "d2m", "u10", "v10", "u100", "v100", "tcc"]
-    level = [2, 2, 10, 10, 100, 100, 0]
-    for k, l in zip(keys, level):
-        if k == "tcc":
-            dataset = xr.open_dataset(
-                path, engine="cfgrib", backend_kwargs={"filter_by_keys": {"stepType": "instant", "typeOfLevel": "atmosphere"}, "indexpath": ""}
-            )  # * Reading Cloud coverage in entire atmosphere level as instant data
-        else:
-            dataset = xr.open_dataset(
-                path, engine="cfgrib", backend_kwargs={"filter_by_keys": {"typeOfLevel": "heightAboveGround", "level": l}, "indexpath": ""}
-            )  # add indexpath='' to avoid garbage file
-        df = dataset[k].to_dataframe()
-        # df.to_csv(f"{path}_{k}.csv")
-        dfs.append(df[k])
-        dataset.close()
-    dfs.append(df["valid_time"])
-    df = pd.concat(dfs, axis=1)
-    df.reset_index(inplace=True)
-    # df.to_csv(fr"Data\csv\{date}\{os.path.basename(path)}.csv")
-    df.to_parquet(rf"{Data}/csv/{date}/{date}_{t}/{os.path.basename(path)}.parquet")
-    shared_queue.put(df)
+def read_gfs_grid(path):
+    """
+    Latitudes and longitudes of the regular GFS grid, decoded from the first message of a GRIB file.
+    Returns 1D (lat, lon) arrays in file order (north to south, west to east).
+    """
+    with open(path, "rb") as f:
+        gid = eccodes.codes_grib_new_from_file(f)
+        try:
+            ny, nx = eccodes.codes_get(gid, "Nj"), eccodes.codes_get(gid, "Ni")
+            lat = eccodes.codes_get_array(gid, "latitudes").reshape(ny, nx)[:, 0]
+            lon = eccodes.codes_get_array(gid, "longitudes").reshape(ny, nx)[0, :]
+        finally:
+            eccodes.codes_release(gid)
+    return lat, lon
+
+
+def read_gfs(path, fields=None):
+    """
+    Walk the GRIB messages of one GFS step once with eccodes and decode the registry fields
+    (gfs_variables.GRIB_FIELDS) into a dense (var, lat, lon) float32 array, in `fields` order,
+    with missing points as NaN. Messages of other fields are skipped without decoding.
+    Returns (values, valid time as numpy.datetime64); raises ValueError if a field is missing.
+    """
+    fields = required_fields() if fields is None else fields
+    slots = grib_lookup(fields)
+    values, found, valid_time = None, set(), None
+    with open(path, "rb") as f:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(f)
+            if gid is None:
+                break
+            try:
+                key = tuple(eccodes.codes_get_long(gid, k) for k in ["parameterCategory", "parameterNumber", "typeOfFirstFixedSurface", "level"])
+                slot = slots.get(key + (eccodes.codes_get(gid, "stepType"),))
+                if slot is None:
+                    continue
+                ny, nx = eccodes.codes_get(gid, "Nj"), eccodes.codes_get(gid, "Ni")
+                if values is None:
+                    values = np.full((len(fields), ny, nx), np.nan, dtype=np.float32)
+                field = eccodes.codes_get_values(gid)
+                if eccodes.codes_get(gid, "bitmapPresent"):
+                    field[field == eccodes.codes_get_double(gid, "missingValue")] = np.nan
+                values[slot] = field.reshape(ny, nx)
+                found.add(slot)
+                if valid_time is None:
+                    stamp = f"{eccodes.codes_get(gid, 'validityDate')}{eccodes.codes_get(gid, 'validityTime'):04d}"
+                    valid_time = np.datetime64(datetime.strptime(stamp, "%Y%m%d%H%M"), "ns")
+            finally:
+                eccodes.codes_release(gid)
+    missing = [field for i, field in enumerate(fields) if i not in found]
+    if missing:
+        raise ValueError(f"{os.path.basename(path)} has no {', '.join(missing)}")
+    return values, valid_time
+
+
+# aggregate() columns holding the PWW variables, in PWW_VARIABLES order
+PWW_COLUMNS = [
+    "tempF102",
+    "DewPointF104",
+    "WindSpeedmph",
+    "WindDirection107",
+    "CloudCoverPerc",
+    "WindSpeed100mph",
+    "GlobalHorizontalIrradianceWM2_120",
+    "DirectHorizontalIrradianceWM2_121",
+]
 
 
 def df_to_pww(df, date, t):
+    """
+    Write a long frame of decoded steps (e.g. read back from the parquet files) as a PWW file.
+    The payload is built as one (time, var, loc) uint8 array and written in a single call.
+    """
     df = aggregate(df)
     logger.info(f"Writing {date}.pww")
     aPWWFileName = rf"{Data}/pww/Forecast_NorthAmerica_Run{date}T{t}Z.pww"
-    aPWWVersion = 1
-    df_station = pd.read_parquet("station.parquet")
     df.sort_values(by=["UTCISO8601","WhoAmI"], inplace=True) #! sort the data by date and location to match the station data 
     # ref: https://stackoverflow.com/questions/17141558/how-to-sort-a-pandas-dataframe-by-two-or-more-columns
-    # convert to ascii null terminated bytes
-    num_unique_date = df["UTCISO8601"].nunique()
-    unique_dates = df["UTCISO8601"].unique()
-    aStartDateTimeUTC = df["UTCISO8601"].min()
-    aEndDateTimeUTC = df["UTCISO8601"].max()
-    # area=[58, -130, 24, -60] North 58°, West -130°, South 24°, East -60°
-    aMinLat = int(df_station["Latitude"].min())
-    aMaxLat = int(df_station["Latitude"].max())
-    aMinLon = int(df_station["Longitude"].min())
-    aMaxLon = int(df_station["Longitude"].max())
-    LOC = df_station["WhoAmI"].nunique()
-
-    sta = open("NOAA_station.pkl", "rb").read()
-    LOC_FC = 0  # for extra loc variables from table 1
-    VARCOUNT = 8  # Set this to the number of weather variable types you have
+
+    # Rows of a date are contiguous after the sort: each block transposed is that date's (var, loc) payload
+    unique_dates, starts = np.unique(df["UTCISO8601"].to_numpy(), return_index=True)
+    values = pww_code(df[PWW_COLUMNS].to_numpy())  # values a byte cannot hold become 255
+    payload = np.concatenate([block.T.ravel() for block in np.split(values, starts[1:])])
 
     # fromate:https://electricgrids.engr.tamu.edu/weather-data/
-    # def df_to_PWW(df):
-    with open(aPWWFileName, "wb") as file:
+    write_pww(aPWWFileName, unique_dates, payload, read_stations())
+    logger.info(f"Finished writing {date}_{t}.pww")
+    return aPWWFileName
+
+
+def read_stations(station_file="NOAA_station.pkl"):
+    """
+    Parse the PWW station table: per station latitude and longitude (double), elevation (int16)
+    and null-terminated WhoAmI, Region and Country2. Returns (raw bytes, lat, lon) in file order,
+    which is the order of the values of every variable in the PWW payload.
+    """
+    sta = open(station_file, "rb").read()
+    lat, lon = [], []
+    pos = 0
+    while pos < len(sta):
+        la, lo = struct.unpack_from("<dd", sta, pos)
+        lat.append(la)
+        lon.append(lo)
+        pos += 18
+        for _ in range(3):
+            pos = sta.index(b"\0", pos) + 1
+    return sta, np.array(lat), np.array(lon)
+
+
+def station_index(station_lat, station_lon, grid_lat, grid_lon):
+    """Flat (lat, lon) grid index of every station, from coordinates on the 0.25 degree grid."""
+    def locate(grid, values):
+        grid = np.round(np.asarray(grid) * 4).astype(np.int64)
+        values = np.round(np.asarray(values) * 4).astype(np.int64)
+        order = np.argsort(grid)
+        pos = order[np.clip(np.searchsorted(grid, values, sorter=order), 0, grid.size - 1)]
+        if (grid[pos] != values).any():
+            raise ValueError("station table does not match the GFS grid")
+        return pos
+    rows = locate(grid_lat, station_lat)
+    cols = locate(np.where(grid_lon > 180, grid_lon - 360, grid_lon), station_lon)
+    return rows * len(grid_lon) + cols
+
+
+def ole_days(valid_times):
+    """datetime64 values to days since 1899-12-30, the PWW date format."""
+    return (np.asarray(valid_times, dtype="datetime64[ns]").astype("int64") + 2209075200 * 10**9) / (10**9 * 86400)
+
+
+def write_pww(file_name, dates, payload, stations, sample_seconds=0):
+    """
+    Write a PWW file: header, variable codes, dates (days since 1899-12-30), the station table and
+    the (time, var, loc) uint8 payload in a single write. `stations` comes from read_stations.
+    With sample_seconds the dates are `sample_seconds` apart: only the first and last are written
+    (in the header) and readers compute the others.
+    """
+    sta, station_lat, station_lon = stations
+    aPWWVersion = 1
+    LOC_FC = 0  # for extra loc variables from table 1
+    with open(file_name, "wb") as file:
         file.write(struct.pack("<h", 2001))
         file.write(struct.pack("<h", 8065))
         file.write(struct.pack("<h", aPWWVersion))
-        file.write(struct.pack("<d", aStartDateTimeUTC))
-        file.write(struct.pack("<d", aEndDateTimeUTC))
-        file.write(struct.pack("<d", aMinLat))
-        file.write(struct.pack("<d", aMaxLat))
-        file.write(struct.pack("<d", aMinLon))
-        file.write(struct.pack("<d", aMaxLon))
+        file.write(struct.pack("<d", dates[0]))
+        file.write(struct.pack("<d", dates[-1]))
+        file.write(struct.pack("<d", int(station_lat.min())))
+        file.write(struct.pack("<d", int(station_lat.max())))
+        file.write(struct.pack("<d", int(station_lon.min())))
+        file.write(struct.pack("<d", int(station_lon.max())))
         file.write(struct.pack("<h", 0))
-        file.write(struct.pack("<i", num_unique_date))  # countNumber of datetime values (COUNT)
-        file.write(struct.pack("<i", 0))
-        file.write(struct.pack("<i", LOC))  # Number of weather measurement locations (LOC)
-        file.write(struct.pack("<h", LOC_FC))  # Loc_FC # Pack the data into INT16 format and write to stream
-        file.write(struct.pack("<h", VARCOUNT))
-
-        # Temp in F
-        file.write(struct.pack("<h", 102))
-        # Dew point in F
-        file.write(struct.pack("<h", 104))
-        # Wind speed at surface (10m) in mph
-        file.write(struct.pack("<h", 106))
-        # Wind direction at surface (10m) in 5-degree increments
-        file.write(struct.pack("<h", 107))
-        # Total cloud cover percentage
-        file.write(struct.pack("<h", 119))
-        # Wind speed at 100m in mph
-        file.write(struct.pack("<h", 110))
-        #? Global Horizontal Irradiance in W/m^2 divided by 4 
-        file.write(struct.pack("<h", 120))
-        #? Direct Horizontal Irradiance in W/m^2 divided by 4
-        file.write(struct.pack("<h", 121))
+        file.write(struct.pack("<i", len(dates)))  # countNumber of datetime values (COUNT)
+        file.write(struct.pack("<i", sample_seconds))  # 0: the dates are listed below
+        file.write(struct.pack("<i", len(station_lat)))  # Number of weather measurement locations (LOC)
+        file.write(struct.pack("<h", LOC_FC))
+        file.write(struct.pack("<h", len(PWW_VARIABLES)))  # VARCOUNT
+        for code in PWW_VARIABLES:
+            file.write(struct.pack("<h", code))
         file.write(struct.pack("<h", 8))  # BYTECOUNT
-        #* Write the dates
-        for date in unique_dates:file.write(struct.pack("<d", date))
-        #* Write the station data
+        if not sample_seconds:
+            file.write(np.asarray(dates, dtype="<f8").tobytes())
         file.write(sta)
-        #* Write the data
-        for date in unique_dates:
-            # Filter rows by unique date
-            rows = df[df["UTCISO8601"] == date]
-
-            for temp in rows["tempF102"]:
-                # file.write(temp.encode('utf-8'))
-                # file.write(struct.pack('<i', temp))
-                file.write(temp.to_bytes(1, "little"))
-
-            for dew_point in rows["DewPointF104"]:
-                # file.write(struct.pack('<b', dew_point.to_bytes(1, 'little')))
-                file.write(dew_point.to_bytes(1, "little"))
-            for wind_speed in rows["WindSpeedmph"]:
-                # file.write(struct.pack('<b', wind_speed.to_bytes(1, 'little')))
-                file.write(wind_speed.to_bytes(1, "little"))
-
-            for wind_direction in rows["WindDirection107"]:
-                # file.write(struct.pack('d', wind_direction))
-                file.write(wind_direction.to_bytes(1, "little"))
-
-            for CloudCoverPerc in rows["CloudCoverPerc"]:
-                # file.write(struct.pack('<b', CloudCoverPerc.to_bytes(1, 'little')))
-                file.write(CloudCoverPerc.to_bytes(1, "little"))
-
-            for WindSpeed100mph in rows["WindSpeed100mph"]:
-                # file.write(struct.pack('<b', WindSpeed100mph.to_bytes(1, 'little')))
-                file.write(WindSpeed100mph.to_bytes(1, "little"))
-
-            for GlobalHorizontalIrradianceWM2_120 in rows["GlobalHorizontalIrradianceWM2_120"]:
-                # file.write(struct.pack('d', GlobalHorizontalIrradianceWM2_120))
-                file.write(GlobalHorizontalIrradianceWM2_120.to_bytes(1, "little"))
-
-            for DirectHorizontalIrradianceWM2_121 in rows["DirectHorizontalIrradianceWM2_121"]: #! this will overflow
-                # file.write(struct.pack('d', DirectHorizontalIrradianceWM2_121))
-                file.write(DirectHorizontalIrradianceWM2_121.to_bytes(1, "little"))
+        file.write(np.ascontiguousarray(payload, dtype=np.uint8).tobytes())
+    return file_name
+
+
+def cube_to_pww(cube, valid_times, lat, lon, date, t, station_file="NOAA_station.pkl", sample_seconds=0):
+    """
+    Write the (time, var, lat, lon) uint8 cube of a cycle as a PWW file, gathering every
+    time/var slice into the station order of `station_file` in one indexing operation.
+    """
+    logger.info(f"Writing {date}.pww")
+    aPWWFileName = rf"{Data}/pww/Forecast_NorthAmerica_Run{date}T{t}Z.pww"
+    stations = read_stations(station_file)
+    index = station_index(stations[1], stations[2], lat, lon)
+    payload = cube.reshape(cube.shape[0], cube.shape[1], -1)[:, :, index]
+    write_pww(aPWWFileName, ole_days(valid_times), payload, stations, sample_seconds)
     logger.info(f"Finished writing {date}_{t}.pww")
     return aPWWFileName
 
 
+def gap_steps(steps):
+    """True for the forecast steps (hours) next to a gap of more than one hour, whose fields hourly_cycle interpolates."""
+    wide = np.diff(np.asarray(steps)) > 1
+    return np.concatenate([wide, [False]]) | np.concatenate([[False], wide])
+
+
+def hourly_cycle(valid_times, codes, held, slot, fields):
+    """
+    Regularize a cycle to hourly steps. `codes` is the (time, var, ...) uint8 PWW cube of the
+    decoded steps and held[slot[i]] the float32 (field, ...) values of step i, or an all-NaN row for
+    steps whose fields were not kept. Decoded hours keep their codes; every other hour is linearly
+    interpolated between the steps around it over the whole cube at once (in blocks of HOURLY_CHUNK
+    hours) and encoded with encode_step, so wind speed and direction come from interpolated u/v.
+    Hours next to a step without fields become 255. Returns (hourly valid times, hourly cube).
+    """
+    hours = (valid_times - valid_times[0]) // np.timedelta64(1, "h")
+    target = np.arange(hours[-1] + 1)
+    out = np.empty((len(target),) + codes.shape[1:], dtype=np.uint8)
+    out[hours] = codes
+    gaps = np.setdiff1d(target, hours)
+    after = np.searchsorted(hours, gaps)
+    before = after - 1
+    weight = ((gaps - hours[before]) / (hours[after] - hours[before])).astype(np.float32)
+    weight = weight.reshape((-1,) + (1,) * (held.ndim - 1))
+    for start in range(0, len(gaps), HOURLY_CHUNK):
+        block = slice(start, start + HOURLY_CHUNK)
+        a, b = held[slot[before[block]]], held[slot[after[block]]]
+        values = a + (b - a) * weight[block]  # (hour, field, ...)
+        out[gaps[block]] = np.moveaxis(encode_step(np.moveaxis(values, 1, 0), fields), 0, 1)
+    return valid_times[0] + target * np.timedelta64(1, "h"), out
+
+
 def download(date, t):
-    attempt = 0
-    # * Downloading the data from the NCEP server https://nomads.ncep.noaa.gov/gribfilter.php?ds=gfs_0p25_1hr
-    x = 0
-    files = []  # store the files that are downloaded
-    
-    # Set this once at the top - only thing you need to change!
-    MAX_X = 384 # Change to 384 for production
-    
-    # Automatically calculate progress bar total
-    max_files = MAX_X + 1  # Always correct!
-    progress_bar = tqdm(total=max_files, desc="Downloading weather data", unit="file")
-    
-    while x <= MAX_X:  # Uses the same variable
-        
-        try:
-            now = time.time_ns()
-            #  Modifying the download URL
-            url = (
-                "https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25_1hr.pl?dir=%2Fgfs."
-                + date
-                + "%2F"
-                + t
-                + "%2Fatmos&file=gfs.t"
-                + t
-                + "z.pgrb2.0p25.f"
-                + "{:03d}".format(x)
-                + "&var_DPT=on&var_TCDC=on&var_TMP=on&var_UGRD=on&var_VGRD=on&lev_2_m_above_ground=on&lev_10_m_above_ground=on&lev_100_m_above_ground=on&lev_1000_mb=on&lev_975_mb=on&lev_950_mb=on&lev_925_mb=on&lev_900_mb=on&lev_850_mb=on&lev_800_mb=on&lev_750_mb=on&lev_700_mb=on&lev_650_mb=on&lev_600_mb=on&lev_550_mb=on&lev_500_mb=on&lev_450_mb=on&lev_400_mb=on&lev_350_mb=on&lev_300_mb=on&lev_250_mb=on&lev_200_mb=on&lev_150_mb=on&lev_100_mb=on&lev_70_mb=on&lev_50_mb=on&lev_boundary_layer_cloud_layer=on&lev_entire_atmosphere=on&lev_convective_cloud_layer=on&lev_high_cloud_layer=on&lev_low_cloud_layer=on&lev_middle_cloud_layer=on&subregion=&toplat=58&leftlon=230&rightlon=300&bottomlat=24"
-            )
-            with urllib.request.urlopen(url) as response, open(f"{Data}/raw/{date}/{date}_{t}/{date}{t}_{x:03d}", "wb") as out_file:
-                shutil.copyfileobj(response, out_file)
-            files.append(f"{date}{t}_{x:03d}")
-            
-            # Update progress bar
-            progress_bar.update(1)
-            progress_bar.set_postfix({"Current file": f"{date}{t}_{x:03d}"})
-            
-        except Exception as e:
-            logger.error(f"Error downloading {date}{t}_{x:03d} {e}")
-            time.sleep(60 * 5)  # wait for 5 minutes before trying again
-            attempt += 1
-            if attempt > 15:
-                logger.error(f"Failed to download {date}{t}_{x:03d} after 5 attempts")
-                break
-            continue
-        x += 1 if x < 120 else 3  # hourly data until 5 day, after every 3 hours.
-        timer = time.time_ns() - now  # * Calculate the time taken to download the file
-
-        sleep = (2e9 - timer) / 1e9  # just hitting the download limit( NCEP has predetermined download limit 50 hits/minutes)
-        if sleep > 0:
-            time.sleep(sleep)  # * Delay for exactly 1 second
-        logger.debug(f"took {timer//1e6} ms to download file {date}{t}_{x:03d}")
-    
-    # Close progress bar
-    progress_bar.close()
-    print(f"✅ Downloaded {len(files)} files successfully!")
-    return files
-    # logger(f"took {timer} ns to download file {date}{t}_{x:03d}")
+    """
+    Download all 209 forecast steps of a GFS cycle from the NCEP server
+    (https://nomads.ncep.noaa.gov/gribfilter.php?ds=gfs_0p25_1hr), several at a time within the
+    NOMADS limit of 50 hits/minute; failed steps are retried on their own (see gfs_download.py).
+    Steps recorded in the cycle's manifest by an earlier, interrupted run are not fetched again.
+    Returns the cycle's CycleManifest.
+    """
+    manifest = download_gfs(date, t, rf"{Data}/raw/{date}/{date}_{t}")
+    print(f"✅ {len(manifest.steps)} files downloaded")
+    return manifest
+
+
 
 
 
+def step_frame(values, valid_time, lat, lon, fields):
+    """Long frame of one decoded step (latitude, longitude, one column per field, valid_time), as saved to parquet."""
+    df = pd.DataFrame({"latitude": np.repeat(lat, lon.size), "longitude": np.tile(lon, lat.size)})
+    for i, k in enumerate(fields):
+        df[k] = values[i].ravel()
+    df["valid_time"] = valid_time
+    return df
+
+
+class ParquetSink:
+    """
+    Background writer of the decoded steps of one cycle (PARQUET_SINK=async). Steps are queued by
+    the parent as workers return them and appended to a single zstd-compressed parquet file, one
+    row group per `batch` steps, so neither the decode workers nor the parent wait on the disk.
+    The parquet is intermediate output: a failed write is logged and does not stop the cycle.
+    """
+
+    def __init__(self, path, lat, lon, fields, batch=PARQUET_BATCH):
+        self.path = path
+        self.lat, self.lon, self.fields = lat, lon, fields
+        self.batch = batch
+        self.written = False
+        if os.path.exists(path):
+            os.remove(path)  # left by an interrupted run; appending would duplicate its steps
+        self.queue = queue.Queue(maxsize=2 * batch)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, valid_time, values):
+        self.queue.put((valid_time, values))
+
+    def run(self):
+        pending = []
+        while True:
+            item = self.queue.get()
+            if item is not None:
+                pending.append(item)
+            if pending and (item is None or len(pending) >= self.batch):
+                self.write(pending)
+                pending = []
+            if item is None:
+                return
+
+    def write(self, steps):
+        try:
+            df = pd.concat([step_frame(values, valid_time, self.lat, self.lon, self.fields) for valid_time, values in steps], ignore_index=True)
+            fastparquet.write(self.path, df, compression="ZSTD", append=self.written, write_index=False)
+            self.written = True
+        except Exception as e:
+            logger.error(f"Error writing {len(steps)} steps to {self.path}: {e}")
+
+    def close(self):
+        """Write the remaining steps and wait for the writer."""
+        self.queue.put(None)
+        self.thread.join()
 
 
 def read_wrapper(args):
-    """Wrapper function for the read function to work with Pool.map"""
-    file, date, t, data_path = args
+    """
+    Decode one forecast step and encode it to PWW codes. With PARQUET_SINK=sync the fields are
+    also saved to the step's parquet; with async, or if `keep` (the step is interpolated by
+    hourly_cycle), they are returned to the parent.
+    Returns (valid time, (var, lat, lon) uint8 codes in PWW_VARIABLES order, fields or None).
+    """
+    file, date, t, data_path, sink, keep = args
     
     # Create a logger for this subprocess
     import logging
     logger = logging.getLogger("weather_api")
     logger.debug(f"Reading {file}")
     
-    dfs = []
-    keys = ["t2m", "d2m", "u10", "v10", "u100", "v100", "tcc"]
-    level = [2, 2, 10, 10, 100, 100, 0]
-    
     try:
-        for k, l in zip(keys, level):
-            if k == "tcc":
-                dataset = xr.open_dataset(
-                    file, engine="cfgrib", 
-                    backend_kwargs={
-                        "filter_by_keys": {"stepType": "instant", "typeOfLevel": "atmosphere"}, 
-                        "indexpath": ""
-                    }
-                )
-            else:
-                dataset = xr.open_dataset(
-                    file, engine="cfgrib", 
-                    backend_kwargs={
-                        "filter_by_keys": {"typeOfLevel": "heightAboveGround", "level": l}, 
-                        "indexpath": ""
-                    }
-                )
-            df = dataset[k].to_dataframe()
-            dfs.append(df[k])
-            dataset.close()
-        
-        dfs.append(df["valid_time"])
-        df = pd.concat(dfs, axis=1)
-        df.reset_index(inplace=True)
+        fields = required_fields()
+        values, valid_time = read_gfs(file, fields)
         
-        # Save to parquet
-        output_path = rf"{data_path}/csv/{date}/{date}_{t}/{os.path.basename(file)}.parquet"
-        df.to_parquet(output_path)
+        if sink == "sync":
+            lat, lon = read_gfs_grid(file)
+            output_path = rf"{data_path}/csv/{date}/{date}_{t}/{os.path.basename(file)}.parquet"
+            step_frame(values, valid_time, lat, lon, fields).to_parquet(output_path)
         
-        # Explicit cleanup
-        del dfs, dataset
-        import gc
-        gc.collect()
-        
-        return df
+        return valid_time, encode_step(values, fields), values if sink == "async" or keep else None
         
     except Exception as e:
         logger.error(f"Error processing {file}: {e}")
@@ -430,69 +518,162 @@ def read_wrapper(args):
 
 
 
-def process_files_safely(raw_files, date, t, data_path):
-    """Process files using a controlled number of worker processes"""
-    
-    # Determine optimal number of workers (don't exceed CPU cores or available memory)
-    cpu_count = mp.cpu_count()
-    available_memory_gb = psutil.virtual_memory().available / (1024**3)
-    
-    # Each process might use ~500MB-1GB of memory for weather data
-    # Conservative estimate: limit based on available memory
-    max_workers_by_memory = max(1, int(available_memory_gb / 1.5))  # 1.5GB per process
-    max_workers_by_cpu = max(1, cpu_count - 1)  # Leave one CPU core free
-    
-    # Use the more conservative limit
-    num_workers = min(max_workers_by_memory, max_workers_by_cpu, 8)  # Cap at 8 processes
-    
-    print(f"🔧 Using {num_workers} worker processes (CPU cores: {cpu_count}, Available RAM: {available_memory_gb:.1f}GB)")
+def process_cycle(raw_files, date, t, data_path, sink=PARQUET_SINK, hourly=HOURLY_PWW, steps=GFS_STEPS):
+    """
+    Decode and encode every step of a cycle on a worker pool sized and throttled by the
+    ResourceGovernor, into a (time, var, lat, lon) uint8 cube in `raw_files` order.
+    `sink` selects how the decoded fields are kept (off, sync or async, see PARQUET_SINK).
+    With `hourly` the cube is regularized to hourly steps (see hourly_cycle); the gaps are taken
+    from the planned `steps`, so hours around a step that failed to download become 255 as in stream_cycle.
+    Returns (valid times, cube, (lat, lon) of the grid).
+    """
     
     # Create logger for this function
     import logging
     logger = logging.getLogger("weather_api")
-    logger.info(f"Processing {len(raw_files)} files with {num_workers} workers")
-    
-    # Prepare arguments for each file - FIXED: Now includes data_path
-    file_args = [(file, date, t, data_path) for file in raw_files]
+
+    # Workers are limited by the cgroup CPUs, the measured per-file peak RSS and MAX_WORKERS
+    governor = ResourceGovernor(
+        max_workers=int(os.environ.get("MAX_WORKERS", 8)), reserve_cores=int(os.environ.get("RESERVE_CORES", 1)), logger=logger
+    )
     
-    # Process files in batches using process pool
-    dfs = []
+    if sink not in ("off", "sync", "async"):
+        raise ValueError(f"PARQUET_SINK must be off, sync or async, not {sink!r}")
+    fields = required_fields()
+    # Files are named {date}{t}_{step:03d} by download_cycle
+    position = {step: i for i, step in enumerate(steps)}
+    planned = np.array([position[int(os.path.basename(file).rsplit("_", 1)[1])] for file in raw_files], dtype=int)
+    # Fields of the steps around the 3-hourly gaps, plus an all-NaN row for the others
+    keep_all = gap_steps(steps) & hourly
+    slot = np.where(keep_all, np.cumsum(keep_all) - 1, keep_all.sum())[planned]
+    keep = keep_all[planned]
+    file_args = [(file, date, t, data_path, sink, kept) for file, kept in zip(raw_files, keep)]
+    lat, lon = read_gfs_grid(raw_files[0])
+    parquet = ParquetSink(rf"{data_path}/csv/{date}/{date}_{t}/{date}_{t}.parquet", lat, lon, fields) if sink == "async" else None
+    cube = np.empty((len(raw_files), len(PWW_VARIABLES), len(lat), len(lon)), dtype=np.uint8)
+    valid_times = np.empty(len(raw_files), dtype="datetime64[ns]")
+    held = np.full((keep_all.sum() + 1, len(fields), len(lat), len(lon)), np.nan, dtype=np.float32)
     
     # Progress bar for file processing
     processing_bar = tqdm(total=len(raw_files), desc="Processing weather files", unit="file")
     
     try:
-        with Pool(processes=num_workers) as pool:
-            # Use imap for better memory management and progress tracking
-            for df in pool.imap(read_wrapper, file_args):
-                dfs.append(df)
+        with governor.executor() as executor:
+            print(f"🔧 Using {governor.pool_size} worker processes")
+            logger.info(f"Processing {len(raw_files)} files with {governor.pool_size} workers")
+            # Tasks are held back while available memory is below MIN_AVAILABLE_GB
+            for i, (valid_time, codes, values) in governor.run(executor, read_wrapper, [(args,) for args in file_args]):
+                valid_times[i] = valid_time
+                cube[i] = codes
+                if keep[i]:
+                    held[slot[i]] = values
+                if parquet is not None:
+                    parquet.put(valid_time, values)
                 processing_bar.update(1)
-                processing_bar.set_postfix({"Processed": len(dfs), "Memory": f"{psutil.virtual_memory().percent:.1f}%"})
-                
-                # Optional: Add memory check and pause if memory usage gets too high
-                if psutil.virtual_memory().percent > 85:
-                    logger.warning(f"High memory usage: {psutil.virtual_memory().percent:.1f}%")
-                    time.sleep(1)  # Brief pause to let system recover
+                processing_bar.set_postfix({"Memory": f"{psutil.virtual_memory().percent:.1f}%"})
                     
     except Exception as e:
         logger.error(f"Error in multiprocessing: {e}")
-        processing_bar.close()
         raise
     finally:
         processing_bar.close()
+        if parquet is not None:
+            parquet.close()
     
-    return dfs
-
-# Update the main function call:
-# Change this line in main():
-# dfs = process_files_safely(raw_files, date, t)
-# TO:
-# dfs = process_files_safely(raw_files, date, t, Data)
-    
-
-
-
+    if hourly:
+        valid_times, cube = hourly_cycle(valid_times, cube, held, slot, fields)
+    return valid_times, cube, (lat, lon)
+
+
+def stream_cycle(date, t, data_path, sink=PARQUET_SINK, station_file="NOAA_station.pkl", hourly=HOURLY_PWW, **download_kwargs):
+    """
+    Download a cycle and decode every step as soon as it is on disk, instead of after the whole
+    (rate-limited) download. The download runs in a thread and reports each complete step, including
+    steps already in the manifest; the step goes straight to a worker, and its codes are gathered
+    into the step's time slot of a preallocated (time, var, loc) PWW payload in station order.
+    With `hourly` the payload is regularized to hourly steps (see hourly_cycle).
+    Returns (valid times, payload, stations) of the steps that were downloaded and decoded.
+    """
+    import logging
+    logger = logging.getLogger("weather_api")
 
+    governor = ResourceGovernor(
+        max_workers=int(os.environ.get("MAX_WORKERS", 8)), reserve_cores=int(os.environ.get("RESERVE_CORES", 1)), logger=logger
+    )
+    if sink not in ("off", "sync", "async"):
+        raise ValueError(f"PARQUET_SINK must be off, sync or async, not {sink!r}")
+    steps = download_kwargs.pop("steps", GFS_STEPS)
+    position = {step: i for i, step in enumerate(steps)}
+    ready = queue.Queue()
+    stations = read_stations(station_file)
+    payload = np.empty((len(steps), len(PWW_VARIABLES), len(stations[1])), dtype=np.uint8)
+    valid_times = np.full(len(steps), np.datetime64("NaT", "ns"))
+    fields = required_fields()
+    # Fields of the steps around the 3-hourly gaps, in station order, plus an all-NaN row for the others
+    keep = gap_steps(steps) & hourly
+    slot = np.where(keep, np.cumsum(keep) - 1, keep.sum())
+    held = np.full((keep.sum() + 1, len(fields), len(stations[1])), np.nan, dtype=np.float32)
+    index = parquet = None
+    in_flight = {}
+
+    def download():
+        try:
+            return download_gfs(date, t, rf"{data_path}/raw/{date}/{date}_{t}", steps=steps,
+                                on_step=lambda step, path: ready.put((position[step], path)), **download_kwargs)
+        finally:
+            ready.put(None)
+
+    def collect(timeout):
+        """Store the codes of finished steps in their payload slots."""
+        done, _ = concurrent.futures.wait(in_flight, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            i = in_flight.pop(future)
+            (valid_time, codes, values), peak_rss = future.result()
+            governor.record(peak_rss)
+            valid_times[i] = valid_time
+            payload[i] = codes.reshape(len(codes), -1)[:, index]
+            if keep[i]:
+                held[slot[i]] = values.reshape(len(values), -1)[:, index]
+            if parquet is not None:
+                parquet.put(valid_time, values)
+
+    with governor.executor() as executor:
+        executor.submit(int).result()  # start the (forked) workers before the download thread exists
+        downloader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        manifest = downloader.submit(download)
+        try:
+            while True:
+                while len(in_flight) >= governor.pool_size or in_flight and not governor.has_room():
+                    collect(timeout=None)
+                try:
+                    item = ready.get(timeout=0.5)
+                except queue.Empty:
+                    if in_flight:
+                        collect(timeout=0)
+                    continue
+                if item is None:
+                    break
+                i, path = item
+                if index is None:
+                    # The grid comes from the first step that lands
+                    lat, lon = read_gfs_grid(path)
+                    index = station_index(stations[1], stations[2], lat, lon)
+                    if sink == "async":
+                        parquet = ParquetSink(rf"{data_path}/csv/{date}/{date}_{t}/{date}_{t}.parquet", lat, lon, fields)
+                in_flight[executor.submit(run_measured, read_wrapper, (path, date, t, data_path, sink, keep[i]))] = i
+            while in_flight:
+                collect(timeout=None)
+            manifest.result()  # download errors
+        finally:
+            downloader.shutdown(wait=True)
+            if parquet is not None:
+                parquet.close()
+
+    done = ~np.isnat(valid_times)
+    logger.info(f"Decoded {done.sum()} of {len(steps)} steps while downloading")
+    if hourly and done.any():
+        return hourly_cycle(valid_times[done], payload[done], held, slot[done], fields) + (stations,)
+    return valid_times[done], payload[done], stations
 
 
 @cronitor.job("zRlIAx")
@@ -531,11 +712,13 @@ def main():
     
     # *-----------------------create the directories and find the date and time to download-----------------------*#
     check = lambda path: True if os.path.exists(path) else os.makedirs(path)
-    today = (datetime.now() - timedelta(days=0))
-    date = today.strftime("%Y%m%d") 
-    pww_date = today.strftime("%Y-%m-%d")
-    times = ["00", "06", "12", "18"]
-    t = times[datetime.now().hour // 6]
+    # The latest cycle that can be complete by now; wait until its last step is listed on NOMADS
+    cycle = latest_cycle(6, GFS_READY_AFTER)
+    date = cycle.strftime("%Y%m%d") 
+    pww_date = cycle.strftime("%Y-%m-%d")
+    t = cycle.strftime("%H")
+    print(f"⏳ Waiting for the {date}_{t} cycle to complete...")
+    wait_for(gfs_idx_url(date, t, GFS_STEPS[-1]), logger=logger)
     check(rf"{Data}/raw/{date}/{date}_{t}")
     check(rf"{Data}/csv/{date}/{date}_{t}")
     check(rf"{Data}/pww")
@@ -545,26 +728,27 @@ def main():
     logger.info(f"Downloading data for {date}_{t}")
     print(f"🌤️  Starting weather data download for {date}_{t}")
     
-    download_files = download(date, t)
-    
-    print("📊 Processing downloaded files...")
-    raw_files = glob.glob(rf"{Data}/raw/{date}/{date}_{t}/*")
-    
-    # Use ONLY the safe processing function
-    dfs = process_files_safely(raw_files, date, t, Data)
-    
-    logger.info(f"concatenating {len(dfs)} dataframes for {date}_{t}")
-    print(f"🔗 Concatenating {len(dfs)} dataframes...")
-    total = len(dfs)
-    df = pd.concat(dfs, copy=False)
-    dfs.clear()  # Free memory
-    
-    
-
-        # Add this debug section right after creating the PWW file and before upload
+    if STREAM_DECODE:
+        # Each step is decoded as it lands; the PWW is written right after the last one
+        print("📊 Decoding files as they download...")
+        valid_times, payload, stations = stream_cycle(date, t, Data)
+        total = len(valid_times)
+        if total == 0:
+            raise RuntimeError(f"No GFS steps downloaded for {date}_{t}")
+        print("💾 Creating PWW file...")
+        pww_file = write_pww(rf"{Data}/pww/Forecast_NorthAmerica_Run{pww_date}T{t}Z.pww", ole_days(valid_times), payload, stations,
+                             sample_seconds=3600 if HOURLY_PWW else 0)
+    else:
+        manifest = download(date, t)
+        
+        print("📊 Processing downloaded files...")
+        raw_files = manifest.files()
+        
+        valid_times, cube, (lat, lon) = process_cycle(raw_files, date, t, Data)
+        total = len(valid_times)
 
-    print("💾 Creating PWW file...")
-    pww_file = df_to_pww(df, pww_date, t)
+        print("💾 Creating PWW file...")
+        pww_file = cube_to_pww(cube, valid_times, lat, lon, pww_date, t, sample_seconds=3600 if HOURLY_PWW else 0)
 
 
 